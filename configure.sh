@@ -11,6 +11,57 @@ DEFAULT_CONFIG='{
   "disable_rule_cron": false,
   "non_dry_run_rule_ids": [
   ],
+  "rule_scheduler": false,
+  "rule_concurrency": 1,
+  "backtest_processes": null,
+  "rule_write_buffer": {
+    "disabled": false,
+    "max_documents": 500,
+    "max_seconds": 1.0,
+    "write_concern": null
+  },
+  "impact_aggregates": {
+    "enabled": false,
+    "collection": "rulesImpact",
+    "max_age": 86400,
+    "refresh_after_run": false
+  },
+  "report_fetch_cache": {
+    "ttl": 300,
+    "max_entries": 32,
+    "disk": false,
+    "path": null,
+    "max_disk_bytes": 536870912
+  },
+  "metrics_store": {
+    "max_age": 3600
+  },
+  "entity_cache_ttls": {
+    "org": 86400,
+    "campaign": 3600,
+    "ad_group": 1800,
+    "keyword": 600
+  },
+  "credential_cache": {
+    "ttl": 600,
+    "max_entries": 16
+  },
+  "mongo_client_pool": {
+    "max_pool_size": 10,
+    "min_pool_size": 0,
+    "wait_queue_timeout": null
+  },
+  "rate_limits": {
+    "default": {
+      "disabled": true,
+      "rate": 5.0,
+      "capacity": 20.0,
+      "reserve": 0.25,
+      "borrow": 0.5,
+      "timeout": 120.0,
+      "per_call": false
+    }
+  },
   "api_status_command": "pm2 show datadragon_api",
   "api_start_command": "pm2 start datadragon_api",
   "api_stop_command": "pm2 stop datadragon_api",
@@ -7,9 +7,12 @@ const uuid = require('uuid');
 const newrelic = require('../modules/newrelic');
 const History = require('../models/rule-history.model');
 const { Credential } = require('../models/credential.model');
+const configure = require('../environment/configure');
+const mongoose = require('mongoose');
 
 const kRuleRunLimit = 5;
 const kRuleTimeoutLimit = 10 * 60 * 1000;  // In milliseconds!
+const kRuleSchedulerCollection = 'ruleSchedulers';
 var currentRuleRuns = [];
 
 function RuleRun(rule) {
@@ -183,6 +186,17 @@ Object.defineProperty(RuleRun.prototype, 'actionsLongDescription', {
   },
 });
 
+// Python rule schedulers keep a heartbeat document until their leases would expire.
+function liveRuleSchedulerCount() {
+  if (!configure.rule_scheduler) { return Promise.resolve(0); }
+  return mongoose.connection.db.collection(kRuleSchedulerCollection)
+    .count({ expiresAt: { $gt: new Date() } })
+    .catch(error => {
+      console.log('Failed to check for a live rule scheduler', error);
+      return 0;
+    });
+}
+
 // use isEnabled outside of the mongoose query
 module.exports.runRules = (completion, overrides) => {
   currentRuleRuns = currentRuleRuns.filter(ruleRun => {
@@ -207,112 +221,119 @@ module.exports.runRules = (completion, overrides) => {
     return true;
     `;
 
-  Rule.where('isEnabled').equals(true)
-    .$where(queryString)
-    .limit(kRuleRunLimit - currentRuleRuns.length)
-    .sort('lastRun')
-    .populate('user')
-    .populate('tasks')
-    .populate({
-      path:'tasks.conditionGroup',
-      model: 'RuleConditionGroup',
-    })
-    .exec((error, rules) => {
-
-    if (error) {
-      console.log(error);
-      completion();
-      return;
+  liveRuleSchedulerCount().then(liveSchedulers => {
+    let query = Rule.where('isEnabled').equals(true);
+    if (liveSchedulers) {
+      // Rules without notifications run in the Python rule scheduler while one is running.
+      query = query.or([{ shouldSendEmail: true }, { shouldMonitor: true }]);
     }
+    query
+      .$where(queryString)
+      .limit(kRuleRunLimit - currentRuleRuns.length)
+      .sort('lastRun')
+      .populate('user')
+      .populate('tasks')
+      .populate({
+        path:'tasks.conditionGroup',
+        model: 'RuleConditionGroup',
+      })
+      .exec((error, rules) => {
+
+      if (error) {
+        console.log(error);
+        completion();
+        return;
+      }
 
-    if (overrides && overrides.rules) {
-      rules = overrides.rules;
-      console.log(`Overriding rules with ${rules.length} provided rules: ${rules.map(r=> r._id).join(', ')}`);
-    }
-    
-    let runsToComplete = [];
+      if (overrides && overrides.rules) {
+        rules = overrides.rules;
+        console.log(`Overriding rules with ${rules.length} provided rules: ${rules.map(r=> r._id).join(', ')}`);
+      }
+      
+      let runsToComplete = [];
 
-    function finish(ruleRun) {
-      ruleRun.end();
-      currentRuleRuns = currentRuleRuns.filter(currentRuleRun => {
-        return currentRuleRun !== ruleRun
-      });
-      runsToComplete = runsToComplete.filter(runToComplete => runToComplete !== ruleRun);
-      if (!runsToComplete.length) { completion(); }
-    }
-    
-    if (rules.length) {
-      console.log('rules retrieved: ', rules.length);
-    }
-    rules.forEach(rule => {
-      let ruleRun = new RuleRun(rule);
-      runsToComplete.push(ruleRun);
-      ruleRun.start();
+      function finish(ruleRun) {
+        ruleRun.end();
+        currentRuleRuns = currentRuleRuns.filter(currentRuleRun => {
+          return currentRuleRun !== ruleRun
+        });
+        runsToComplete = runsToComplete.filter(runToComplete => runToComplete !== ruleRun);
+        if (!runsToComplete.length) { completion(); }
+      }
       
-      let credential;
-      Credential.credentialDataForPath(rule.account).then(c => credential = c).then(() => Rule.updateLastRunByID(rule._id, new Date())).then(rule => {
-        currentRuleRuns.push(ruleRun);
-        console.log('Executing rule:', rule.metadata.title || rule.metadata.description, '[', rule._id, ']');
-
-        let shell = executeRule(rule, credential, (errors, result) => {
-          console.log('Rule execution ended:', rule.metadata.title || rule.metadata.description, '[', rule._id, ']');
-          if (errors.length > 0) {
-            console.log('Error thrown by rule:', rule.metadata.title || rule.metadata.description, '[', rule._id, ']', JSON.stringify(errors));
-            Rule.log(rule)
-            console.log(errors);
-            ruleRun.error(errors);
-            let text = '### 🚨 DATADRAGON Error thrown by rule\n\n' + ruleRun.ruleLongName + '\n\n' + ruleRun.ruleLongDescription + '\n\nThis rule threw an unexpected error. Please let us know at ' + email.replyToEmail + ' if it keeps throwing errors and we\'ll work on fixing them.\n\n### Error output\n\n<code>\n' + ruleRun.errorsLongDescription + '\n</code>\n\n### Debugging information\n\n' + ruleRun.ruleDebugDescription;
-            sendRuleEmail(rule, text, '🚨 DATADRAGON Rule Error 🚨 Re: ' + ruleRun.ruleShortName);
-          }
-
-          if (result && result.report) {
-            ruleRun.triggered(result);
-            rule.lastTriggered = new Date();
-            rule.save();
-
-            if (result.actionResults) {
-              result.actionResults.forEach((actionResult, index) => {
-                if (!actionResult.apiResponse) { return; }
-                console.log('Rule result api response for action ' + index + ': ', actionResult.apiResponse);
-              });
-              if (!rule.shouldPerformAction) {
+      if (rules.length) {
+        console.log('rules retrieved: ', rules.length);
+      }
+      rules.forEach(rule => {
+        let ruleRun = new RuleRun(rule);
+        runsToComplete.push(ruleRun);
+        ruleRun.start();
+        
+        let credential;
+        Credential.credentialDataForPath(rule.account).then(c => credential = c).then(() => Rule.updateLastRunByID(rule._id, new Date())).then(rule => {
+          currentRuleRuns.push(ruleRun);
+          console.log('Executing rule:', rule.metadata.title || rule.metadata.description, '[', rule._id, ']');
+
+          let shell = executeRule(rule, credential, (errors, result) => {
+            console.log('Rule execution ended:', rule.metadata.title || rule.metadata.description, '[', rule._id, ']');
+            if (errors.length > 0) {
+              console.log('Error thrown by rule:', rule.metadata.title || rule.metadata.description, '[', rule._id, ']', JSON.stringify(errors));
+              Rule.log(rule)
+              console.log(errors);
+              ruleRun.error(errors);
+              let text = '### 🚨 DATADRAGON Error thrown by rule\n\n' + ruleRun.ruleLongName + '\n\n' + ruleRun.ruleLongDescription + '\n\nThis rule threw an unexpected error. Please let us know at ' + email.replyToEmail + ' if it keeps throwing errors and we\'ll work on fixing them.\n\n### Error output\n\n<code>\n' + ruleRun.errorsLongDescription + '\n</code>\n\n### Debugging information\n\n' + ruleRun.ruleDebugDescription;
+              sendRuleEmail(rule, text, '🚨 DATADRAGON Rule Error 🚨 Re: ' + ruleRun.ruleShortName);
+            }
+
+            if (result && result.report) {
+              ruleRun.triggered(result);
+              rule.lastTriggered = new Date();
+              rule.save();
+
+              if (result.actionResults) {
                 result.actionResults.forEach((actionResult, index) => {
-                  if (!actionResult.logs) { return; }
-                  console.log('Rule dry run result logs for action ' + index + ': ', actionResult.logs);
+                  if (!actionResult.apiResponse) { return; }
+                  console.log('Rule result api response for action ' + index + ': ', actionResult.apiResponse);
                 });
-              }  
-            }
+                if (!rule.shouldPerformAction) {
+                  result.actionResults.forEach((actionResult, index) => {
+                    if (!actionResult.logs) { return; }
+                    console.log('Rule dry run result logs for action ' + index + ': ', actionResult.logs);
+                  });
+                }  
+              }
 
-            if (rule.shouldSendEmail || rule.shouldMonitor) {
-              let attachments = [ {
-                filename: `datadragon-rule-alert-${ruleRun.rule._id}-${ruleRun.startDate.toISOString().replace(/:/g, '.')}.csv`,
-                content: result.report,
-                contentType: 'text/csv'
-              }];
-              var text = '### DATADRAGON Notification triggered for rule\n\n' + ruleRun.ruleLongName + '\n\n' + ruleRun.ruleLongDescription + '\n\nThis rule triggered an alert because its conditions were met and its *Send Email* option was checked. Please find the data that triggered this rule in the attached CSV document.';
-              if (ruleRun.actions.length > 0) {
-                text += '\n\n### ' + ((ruleRun.rule.shouldPerformAction) ? 'Actions taken' : 'Actions the rule *would have* taken if it weren\'t a dry run') + '\n\n' + ruleRun.actionsLongDescription;
+              if (rule.shouldSendEmail || rule.shouldMonitor) {
+                let attachments = [ {
+                  filename: `datadragon-rule-alert-${ruleRun.rule._id}-${ruleRun.startDate.toISOString().replace(/:/g, '.')}.csv`,
+                  content: result.report,
+                  contentType: 'text/csv'
+                }];
+                var text = '### DATADRAGON Notification triggered for rule\n\n' + ruleRun.ruleLongName + '\n\n' + ruleRun.ruleLongDescription + '\n\nThis rule triggered an alert because its conditions were met and its *Send Email* option was checked. Please find the data that triggered this rule in the attached CSV document.';
+                if (ruleRun.actions.length > 0) {
+                  text += '\n\n### ' + ((ruleRun.rule.shouldPerformAction) ? 'Actions taken' : 'Actions the rule *would have* taken if it weren\'t a dry run') + '\n\n' + ruleRun.actionsLongDescription;
+                }
+                text += '\n\n### Debugging information\n\n' + ruleRun.ruleDebugDescription + '\n\n### CSV report data\n\n'
+                sendRuleEmail(rule, text, 'DATADRAGON Rule Notification 🔮 Re: ' + ruleRun.ruleShortName, attachments);
+              } else {
+                console.log('Did not have to send email about ');
+                Rule.log(rule);
               }
-              text += '\n\n### Debugging information\n\n' + ruleRun.ruleDebugDescription + '\n\n### CSV report data\n\n'
-              sendRuleEmail(rule, text, 'DATADRAGON Rule Notification 🔮 Re: ' + ruleRun.ruleShortName, attachments);
             } else {
-              console.log('Did not have to send email about ');
-              Rule.log(rule);
+              console.log('Did not get result data: ', result);
+              ruleRun.notTriggered();
             }
-          } else {
-            console.log('Did not get result data: ', result);
-            ruleRun.notTriggered();
-          }
 
-          finish(ruleRun);
-        }, overrides);
+            finish(ruleRun);
+          }, overrides);
 
-        ruleRun.assignShell(shell);
-      },
-        err => {
-        console.log('Error saving rule', err);
-        finish(ruleRun);
-        });
+          ruleRun.assignShell(shell);
+        },
+          err => {
+          console.log('Error saving rule', err);
+          finish(ruleRun);
+          });
+      });
     });
   });
 };
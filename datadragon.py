@@ -1,4 +1,4 @@
-from scripts import run
+from scripts.run import run
 
 if __name__ == '__main__':
   run()
\ No newline at end of file
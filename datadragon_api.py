@@ -1,3 +1,4 @@
 from scripts import api
 
-api.run()
\ No newline at end of file
+if __name__ == '__main__':
+  api.run()
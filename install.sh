@@ -37,6 +37,8 @@ cd development_packages
 install_development_packages
 cd ../..
 
+python -m scripts.map_manifest
+
 deactivate
 
 npm install
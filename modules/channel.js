@@ -46,7 +46,7 @@ function getChannelReport({credential, timeGranularity, entityGranularity, start
     shell.on('message', message => {
       if (message.log !== undefined) {
         console.log(message.log);
-      } else {
+      } else if (message.data !== undefined) {
         data = message.data;
       }
     });
@@ -84,7 +84,7 @@ function getCredentialEntities(credential, entity, parentEntityIDs) {
     shell.on('message', message => {
       if (message.log !== undefined) {
         console.log(message.log);
-      } else {
+      } else if (message.data !== undefined) {
         data = message.data;
       }
     });
@@ -108,7 +108,7 @@ function getCredentialEntities(credential, entity, parentEntityIDs) {
     shell.on('message', message => {
       if (message.log !== undefined) {
         console.log(message.log);
-      } else {
+      } else if (message.data !== undefined) {
         data = message.data;
       }
     });
@@ -129,7 +129,7 @@ function getCredentialEntities(credential, entity, parentEntityIDs) {
     shell.on('message', message => {
       if (message.log !== undefined) {
         console.log(message.log);
-      } else {
+      } else if (message.data !== undefined) {
         data = message.data;
       }
     });
@@ -1,2 +0,0 @@
-from .run import run
-from .import api
\ No newline at end of file
@@ -0,0 +1,32 @@
+from bson import ObjectId
+from typing import Dict, List, Optional
+
+path_separator = '_'
+
+def unescaped_path_component(component: str) -> str:
+  return component.replace('-5F', '_').replace('-2D', '-')
+
+def components_from_path(path: str) -> List[str]:
+  return [unescaped_path_component(c) for c in path.split(path_separator)]
+
+def account_credentials(db: any, account: str) -> Optional[Dict[str, any]]:
+  components = components_from_path(path=account)
+  conditions = {
+    'user': ObjectId(components[1]),
+    'target': components[3],
+    'name': components[4],
+  }
+  credential = db.credentials.find_one(conditions)
+  if credential is not None:
+    return credential['credential']
+  if conditions['target'] == 'apple_search_ads':
+    certificate = db.certificates.find_one({
+      'user': conditions['user'],
+      'name': conditions['name'],
+    })
+    if certificate is not None:
+      return {
+        'org_name': str(certificate['_id']),
+        **certificate['credentials'],
+      }
+  return None
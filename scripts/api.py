@@ -1,193 +1,906 @@
 import sys
 import os
 import json
+import time
+import hashlib
+import threading
+import importlib
+import traceback
 
 from enum import Enum
 from pathlib import Path
 from .channel import Channel
-from io_fetch_channel import ChannelPerformanceFetcher
-from io_channel import IOSharedResourceMap
-from regla import channel_factory, ChannelEntity, RuleSerializer
-from datetime import datetime
-from typing import Dict
+from .timing import CommandMetrics, current_metrics, measuring, span, count
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple, Callable, Optional, TextIO
 
 class Command(Enum):
   campaigns = 'campaigns'
   adgroups = 'adgroups'
   orgs = 'orgs'
+  entity_tree = 'entity_tree'
   execute_rule = 'execute_rule'
+  execute_rules = 'execute_rules'
+  backtest_rule = 'backtest_rule'
   impact_report = 'impact_report'
   channel_report = 'channel_report'
+  metrics_fetch = 'metrics_fetch'
   enity_report = 'entity_report'
   rule_report = 'rule_report'
   report = 'report'
   entity_process = 'entity_process'
+  statistics = 'statistics'
+  serve = 'serve'
+
+command_modules: Dict[Command, List[str]] = {
+  Command.orgs: ['io_channel', 'regla'],
+  Command.campaigns: ['io_channel', 'regla'],
+  Command.adgroups: ['io_channel', 'regla'],
+  Command.entity_tree: ['io_channel', 'regla'],
+  Command.execute_rule: ['io_channel', 'regla', 'io_map', 'scripts.rule_executor'],
+  Command.execute_rules: ['io_channel', 'regla', 'io_map', 'scripts.rule_executor'],
+  Command.backtest_rule: ['io_channel', 'regla', 'io_map', 'scripts.rule_executor'],
+  Command.impact_report: ['io_channel', 'io_map', 'scripts.rule_executor'],
+  Command.channel_report: ['io_channel', 'io_fetch_channel'],
+  Command.metrics_fetch: ['io_channel', 'io_fetch_channel', 'scripts.metrics_store'],
+  Command.report: ['io_channel', 'scripts.report'],
+  Command.entity_process: ['io_channel', 'scripts.entity'],
+}
+
+def import_command_modules(command: Command):
+  for module_name in command_modules.get(command, []):
+    importlib.import_module(module_name)
+
+class CommandIO:
+  write_line: Callable[[str], None]
+  read_line: Callable[[], str]
+  log_buffer: List[str]
+  log_buffer_bytes: int
+  log_buffer_start: Optional[float]
+  log_flush_bytes = 64 * 1024
+  log_flush_seconds = 1.0
+  _lock: threading.RLock
+
+  def __init__(self, write_line: Callable[[str], None], read_line: Callable[[], str]):
+    self.write_line = write_line
+    self.read_line = read_line
+    self.log_buffer = []
+    self.log_buffer_bytes = 0
+    self.log_buffer_start = None
+    self._lock = threading.RLock()
+
+  def _write(self, line: str):
+    with self._lock:
+      self._flush_logs()
+      self.write_line(line)
+    count('outputBytes', len(line))
+    count('outputMessages')
+
+  def _flush_logs(self):
+    if not self.log_buffer:
+      return
+    text = ''.join(self.log_buffer)
+    self.log_buffer = []
+    self.log_buffer_bytes = 0
+    self.log_buffer_start = None
+    self.write_line(json.dumps({'log': text}))
+
+  def flush_logs(self):
+    with self._lock:
+      self._flush_logs()
+
+  def _schedule_log_flush(self):
+    timer = threading.Timer(self.log_flush_seconds, self.flush_logs)
+    timer.daemon = True
+    timer.start()
+
+  def log(self, text: str):
+    with self._lock:
+      now = time.monotonic()
+      if self.log_buffer_start is None:
+        self.log_buffer_start = now
+        self._schedule_log_flush()
+      self.log_buffer.append(text)
+      self.log_buffer_bytes += len(text)
+      if self.log_buffer_bytes >= self.log_flush_bytes or now - self.log_buffer_start >= self.log_flush_seconds:
+        self._flush_logs()
+
+  def send(self, message: Dict[str, any], cls: Optional[type]=None):
+    start = time.perf_counter()
+    if cls is None:
+      line = json.dumps(message)
+    else:
+      from .encoding import encode_message
+      line = encode_message(message, cls=cls)
+    count('serializeSeconds', time.perf_counter() - start)
+    self._write(line)
+
+  def send_json(self, text: str):
+    self._write(text)
+
+  def receive(self) -> str:
+    self.flush_logs()
+    return self.read_line()
+
+standard_command_io = CommandIO(
+  write_line=print,
+  read_line=input
+)
+
+_command_context = threading.local()
+unbound_log_stream: Optional[TextIO] = None
+
+def current_command_io() -> CommandIO:
+  command_io = getattr(_command_context, 'command_io', None)
+  return command_io if command_io is not None else standard_command_io
+
+def bind_command_io(function: Callable) -> Callable:
+  from .cassette import current_cassette, using
+  command_io = getattr(_command_context, 'command_io', None)
+  metrics = current_metrics()
+  cassette = current_cassette()
+  def bound_function(*args, **kwargs):
+    previous_command_io = getattr(_command_context, 'command_io', None)
+    _command_context.command_io = command_io
+    try:
+      with measuring(metrics), using(active=cassette):
+        return function(*args, **kwargs)
+    finally:
+      _command_context.command_io = previous_command_io
+  return bound_function
+
+def log_message(message: str, end: str):
+  command_io = getattr(_command_context, 'command_io', None)
+  if command_io is not None:
+    command_io.log(message + end)
+  elif unbound_log_stream is not None:
+    unbound_log_stream.write(message + end)
+    unbound_log_stream.flush()
+  else:
+    standard_command_io.send({'log': message + end})
+
+def load_configure() -> Dict[str, any]:
+  with open(Path(__file__).parent.parent / 'configure.json') as f:
+    return json.load(f)
+
+def credentials_fingerprint(credentials: any) -> str:
+  return hashlib.sha256(json.dumps(credentials, sort_keys=True, default=str).encode()).hexdigest()
 
 def prepare_credentials(args: Dict[str, any]) -> Dict[str, any]:
-  shared_credentials_map = IOSharedResourceMap(url_key='shared_credentials_url')
-  credentials = shared_credentials_map.run(args['credentials'])
-  return credentials
+  from .credential_cache import credential_cache
+  def resolve_credentials() -> Dict[str, any]:
+    from io_channel import IOSharedResourceMap
+    shared_credentials_map = IOSharedResourceMap(url_key='shared_credentials_url')
+    return shared_credentials_map.run(args['credentials'])
+  with span('credentials'):
+    return credential_cache.resolve(
+      fingerprint=credentials_fingerprint(args['credentials']),
+      resolve=resolve_credentials
+    )
 
-def run():
-  args = json.loads(sys.argv[1])
+background_commands = {
+  Command.execute_rule,
+  Command.execute_rules,
+  Command.backtest_rule,
+  Command.metrics_fetch,
+}
+
+def channel_rate_limit(args: Dict[str, any], configure: Dict[str, any], channel: Optional[str]=None, interactive: Optional[bool]=None) -> any:
+  from .rate_limiter import rate_limiter, install_http_rate_limit
+  install_http_rate_limit()
+  if interactive is None:
+    if 'priority' in args:
+      interactive = args['priority'] == 'interactive'
+    else:
+      interactive = Command(args['command']) not in background_commands
+  return rate_limiter.limit(
+    channel=channel if channel is not None else args['channel'],
+    credentials_fingerprint=credentials_fingerprint(args['credentials']),
+    buckets=configure.get('rate_limits', {}),
+    interactive=interactive
+  )
+
+def get_entities(args: Dict[str, any], configure: Dict[str, any], channel: any, entity_type: any, parent_ids: Optional[Dict[any, str]]=None) -> List[Dict[str, any]]:
+  from .entity_cache import shared_entity_cache
+  def fetch() -> List[Dict[str, any]]:
+    with channel_rate_limit(args, configure):
+      return channel.get_entities(
+        entity_type=entity_type,
+        **({'parent_ids': parent_ids} if parent_ids is not None else {})
+      )
+  return shared_entity_cache(ttls=configure.get('entity_cache_ttls', {})).get_entities(
+    channel=args['channel'],
+    credentials_fingerprint=credentials_fingerprint(args['credentials']),
+    level=entity_type.name,
+    parent_ids=parent_ids,
+    fetch=fetch,
+    refresh=args.get('refresh', False)
+  )
+
+def run_orgs(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from regla import channel_factory, ChannelEntity
+  channel = channel_factory(channel_identifier=args['channel'])
+  with channel.connected(credentials=prepare_credentials(args)):
+    orgs = get_entities(
+      args=args,
+      configure=configure,
+      channel=channel,
+      entity_type=ChannelEntity.org
+    )
+  command_io.send({
+    'data': [
+      {
+        **d,
+        'id': d['id'],
+      } for d in orgs
+    ]
+  })
+
+def run_campaigns(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from regla import channel_factory, ChannelEntity
+  channel = channel_factory(channel_identifier=args['channel'])
+  with channel.connected(credentials=prepare_credentials(args)):
+    campaigns = [
+      campaign
+      for org in args['orgs']
+      for campaign in get_entities(
+        args=args,
+        configure=configure,
+        channel=channel,
+        entity_type=ChannelEntity.campaign,
+        parent_ids={ChannelEntity.org: str(org['id'])}
+      )
+    ]
+  command_io.send({
+    'data': [
+      {
+        **d,
+        'org_id': d['org_id'],
+        'id': d['id'],
+      } for d in campaigns
+    ]
+  })
+
+def run_adgroups(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from regla import channel_factory, ChannelEntity
+  channel = channel_factory(channel_identifier=args['channel'])
+  with channel.connected(credentials=prepare_credentials(args)):
+    ad_groups = get_entities(
+      args=args,
+      configure=configure,
+      channel=channel,
+      entity_type=ChannelEntity.ad_group,
+      parent_ids={ChannelEntity.org: str(args['orgID']), ChannelEntity.campaign: str(args['campaignID'])}
+    )
+  command_io.send({
+    'data': [
+      {
+        **d,
+        'org_id': d['org_id'],
+        'campaign_id': d['campaign_id'],
+        'id': d['id'],
+      } for d in ad_groups
+    ]
+  })
+
+def apply_dry_run_configuration(rule: any, args: Dict[str, any], configure: Dict[str, any]):
   from moda import log
-  log.set_message_logger(lambda message, end: print(json.dumps({'log': message + end})))
-  with open(Path(__file__).parent.parent / 'configure.json') as f:
-    configure = json.load(f)
-  command = Command(args['command'])
+  if configure['dry_run_only'] is not False or ('dryRunOnly' in args and args['dryRunOnly']):
+    if rule._id in configure['non_dry_run_rule_ids']:
+      log.log(f'Allowing non dry run for rule {rule._id} despite dry_run_only configuration because rule is listed in the non_dry_run_rule_ids configuration.')
+    elif 'nonDryRunRuleIDs' in args and rule._id in args['nonDryRunRuleIDs']:
+      log.log(f'Allowing non dry run for rule {rule._id} despite dry_run_only configuration because rule is listed in the nonDryRunRuleIDs argument.')
+    else:
+      if not rule.dryRun:
+        log.log(f'Forcing dry run for rule {rule._id} due to dry_run_only configuration.')
+      rule.dryRun = True
 
-  if command is Command.orgs:
-    channel = channel_factory(channel_identifier=args['channel'])
-    with channel.connected(credentials=prepare_credentials(args)):
-      orgs = channel.get_entities(entity_type=ChannelEntity.org)
-    print(json.dumps({
-      'data': [
-        {
-          **d,
-          'id': d['id'],
-        } for d in orgs
-      ]
-    }))
-
-  elif command is Command.campaigns:
-    channel = channel_factory(channel_identifier=args['channel'])
-    with channel.connected(credentials=prepare_credentials(args)):
-      campaigns = [
-        campaign 
-        for org in args['orgs']
-        for campaign in channel.get_entities(
-          entity_type=ChannelEntity.campaign,
-          parent_ids={ChannelEntity.org: str(org['id'])}
-        )
-      ]
-    print(json.dumps({
-      'data': [
-        {
-          **d,
-          'org_id': d['org_id'],
-          'id': d['id'],
-        } for d in campaigns
-      ]
-    }))
-
-  elif command is Command.adgroups:
-    channel = channel_factory(channel_identifier=args['channel'])
-    with channel.connected(credentials=prepare_credentials(args)):
-      ad_groups = channel.get_entities(
-        entity_type=ChannelEntity.ad_group,
-        parent_ids={ChannelEntity.org: str(args['orgID']), ChannelEntity.campaign: str(args['campaignID'])}
+def run_entity_tree(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from concurrent.futures import ThreadPoolExecutor
+  from regla import channel_factory, ChannelEntity
+  hierarchy = ['org', 'campaign', 'ad_group', 'keyword']
+  levels = hierarchy[:hierarchy.index(args.get('deepestLevel', 'ad_group')) + 1]
+  max_workers = args.get('maxWorkers', 4)
+  parent_id_keys = [
+    (ChannelEntity.org, 'org_id'),
+    (ChannelEntity.campaign, 'campaign_id'),
+    (ChannelEntity.ad_group, 'ad_group_id'),
+  ]
+
+  def parent_ids(parent: Dict[str, any], parent_level: int) -> Dict[ChannelEntity, str]:
+    ids = {
+      entity: str(parent[key])
+      for entity, key in parent_id_keys[:parent_level]
+    }
+    ids[parent_id_keys[parent_level][0]] = str(parent['id'])
+    return ids
+
+  channel = channel_factory(channel_identifier=args['channel'])
+  counts = {}
+  with channel.connected(credentials=prepare_credentials(args)), ThreadPoolExecutor(max_workers=max_workers) as executor:
+    if 'orgs' in args:
+      parents = args['orgs']
+    else:
+      parents = get_entities(
+        args=args,
+        configure=configure,
+        channel=channel,
+        entity_type=ChannelEntity.org
       )
-    print(json.dumps({
-      'data': [
-        {
-          **d,
-          'org_id': d['org_id'],
-          'campaign_id': d['campaign_id'],
-          'id': d['id'],
-        } for d in ad_groups
-      ]
-    }))
-
-  elif command is Command.execute_rule:
-    from io_map import IOMap
-    IOMap.map_auto_register = True
-    from .rule_executor import RuleExecutor
-    date_format = '%Y-%m-%d'
-    rule_executor = RuleExecutor(options=args['dbConfig'])
-    rule = rule_executor.get_rule(rule_id=args['ruleID'])
-    if configure['dry_run_only'] is not False or ('dryRunOnly' in args and args['dryRunOnly']):
-      if rule._id in configure['non_dry_run_rule_ids']:
-        log.log(f'Allowing non dry run for rule {rule._id} despite dry_run_only configuration because rule is listed in the non_dry_run_rule_ids configuration.')
-      elif 'nonDryRunRuleIDs' in args and rule._id in args['nonDryRunRuleIDs']:
-        log.log(f'Allowing non dry run for rule {rule._id} despite dry_run_only configuration because rule is listed in the nonDryRunRuleIDs argument.')
-      else:
-        if not rule.dryRun:
-          log.log(f'Forcing dry run for rule {rule._id} due to dry_run_only configuration.')
-        rule.dryRun = True
+    for level_index, level in enumerate(levels):
+      if level_index:
+        fetch = bind_command_io(lambda parent: get_entities(
+          args=args,
+          configure=configure,
+          channel=channel,
+          entity_type=ChannelEntity[level],
+          parent_ids=parent_ids(parent=parent, parent_level=level_index - 1)
+        ))
+        parents = [
+          entity
+          for entities in executor.map(fetch, parents)
+          for entity in entities
+        ]
+      counts[level] = len(parents)
+      command_io.send({
+        'level': level,
+        'data': parents,
+      })
+
+  command_io.send({
+    'result': {
+      'levels': levels,
+      'counts': counts,
+    },
+  })
+
+def prepare_rule_executor(args: Dict[str, any], configure: Dict[str, any]) -> any:
+  from .mongo_pool import mongo_client_pool
+  from .rule_executor import RuleExecutor
+  mongo_client_pool.configure(**configure.get('mongo_client_pool', {}))
+  return RuleExecutor(
+    options=impact_collection_options(options=args['dbConfig'], configure=configure),
+    write_buffer=enabled_options(configure.get('rule_write_buffer', {})),
+    impact_aggregates=impact_aggregate_options(configure=configure)
+  )
+
+def enabled_options(options: Dict[str, any], exclude: List[str]=[]) -> Optional[Dict[str, any]]:
+  if options.get('disabled'):
+    return None
+  return {k: v for k, v in options.items() if k != 'disabled' and k not in exclude}
+
+def impact_aggregate_options(configure: Dict[str, any]) -> Optional[Dict[str, any]]:
+  options = configure.get('impact_aggregates', {})
+  if not options.get('enabled'):
+    return None
+  return {k: v for k, v in options.items() if k not in ['enabled', 'collection', 'refresh_after_run']}
+
+def impact_collection_options(options: Dict[str, any], configure: Dict[str, any]) -> Dict[str, any]:
+  collection = configure.get('impact_aggregates', {}).get('collection')
+  return {**options, 'rulesImpactCollection': collection} if collection else options
+
+def update_impact_aggregate(rule_executor: any, credentials: any, rule: any, rule_id: str, since: datetime, configure: Dict[str, any]):
+  if rule_executor.impact_store is None:
+    return
+  if configure.get('impact_aggregates', {}).get('refresh_after_run', False):
+    rule_executor.refresh_impact_aggregate(
+      credentials=credentials,
+      rule=rule,
+      rule_id=rule_id,
+      since=since
+    )
+  else:
+    rule_executor.impact_store.invalidate(rule_id=rule_id)
+
+def refresh_impact_aggregate(rule_executor: any, credentials: any, rule: any, rule_id: str, since: datetime, configure: Dict[str, any], command_io: CommandIO):
+  try:
+    update_impact_aggregate(
+      rule_executor=rule_executor,
+      credentials=credentials,
+      rule=rule,
+      rule_id=rule_id,
+      since=since,
+      configure=configure
+    )
+  except Exception:
+    command_io.log(f'Failed to update impact aggregate for rule {rule_id}\n{traceback.format_exc()}')
+
+def write_failure_errors(failures: List[Dict[str, any]]) -> List[str]:
+  return [
+    f'Failed to write {f["failed"]} of {f["documents"]} documents to {f["collection"]}: {f["error"]}'
+    for f in failures
+  ]
+
+def run_execute_rule(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from regla import RuleSerializer
+  from .map_manifest import register_map_identifiers
+  register_map_identifiers()
+  date_format = '%Y-%m-%d'
+  rule_executor = prepare_rule_executor(args, configure)
+  rule = rule_executor.get_rule(rule_id=args['ruleID'])
+  apply_dry_run_configuration(
+    rule=rule,
+    args=args,
+    configure=configure
+  )
+  credentials = prepare_credentials(args)
+  channel = args.get('channel') or rule_executor.get_rule_channels(rule_ids=[args['ruleID']]).get(args['ruleID'])
+  with channel_rate_limit(args, configure, channel=channel):
     result = rule_executor.execute(
-      credentials=prepare_credentials(args),
+      credentials=credentials,
       rule=rule,
       granularity=args['granularity'],
       start_date=datetime.strptime(args['startDate'], date_format),
       end_date=datetime.strptime(args['endDate'], date_format)
     )
 
-    print(json.dumps({
-      "result" : result,
-    }, cls=RuleSerializer))
+  message = {
+    "result" : result,
+  }
+  if rule_executor.write_failures:
+    message['writeFailures'] = rule_executor.write_failures
+    message['errors'] = write_failure_errors(rule_executor.write_failures)
+  command_io.send(message, cls=RuleSerializer)
+  with channel_rate_limit(args, configure, channel=channel):
+    refresh_impact_aggregate(
+      rule_executor=rule_executor,
+      credentials=credentials,
+      rule=rule,
+      rule_id=args['ruleID'],
+      since=datetime.strptime(args['startDate'], date_format),
+      configure=configure,
+      command_io=command_io
+    )
 
-  elif command is Command.impact_report:
-    from io_map import IOMap
-    IOMap.map_auto_register = True
-    from .rule_executor import RuleExecutor
-    date_format = '%Y-%m-%d'
-    credentials = prepare_credentials(args)
-    rule_id = args['ruleID']
-    report_id = args['reportID']
+def run_execute_rules(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  import copy
+  from concurrent.futures import ThreadPoolExecutor
+  from regla import RuleSerializer
+  from .map_manifest import register_map_identifiers
+  register_map_identifiers()
+  date_format = '%Y-%m-%d'
+  concurrency = max(1, args.get('concurrency', configure.get('rule_concurrency', 1)))
+  rule_executor = prepare_rule_executor(args, configure)
+  thread_executors = threading.local()
+  credential_groups: Dict[str, List[Dict[str, any]]] = {}
+  for rule_args in args['rules']:
+    fingerprint = credentials_fingerprint(rule_args['credentials'])
+    credential_groups.setdefault(fingerprint, []).append(rule_args)
 
-    rule_executor = RuleExecutor(options=args['dbConfig'])
-    rule = rule_executor.get_rule(rule_id=rule_id)
+  load_errors = None
+  try:
+    rules = rule_executor.get_rules(rule_ids=[rule_args['ruleID'] for rule_args in args['rules']])
+    rule_channels = rule_executor.get_rule_channels(rule_ids=[rule_args['ruleID'] for rule_args in args['rules']])
+  except Exception:
+    load_errors = [traceback.format_exc()]
+
+  def execute_rule(rule_args: Dict[str, any], credentials: any) -> Tuple[Dict[str, any], bool]:
+    if getattr(thread_executors, 'rule_executor', None) is None:
+      thread_executors.rule_executor = prepare_rule_executor(args, configure)
+    rule_executor = thread_executors.rule_executor
+    rule_id = rule_args['ruleID']
+    channel = rule_args.get('channel', rule_channels.get(rule_id))
+    try:
+      credentials = copy.deepcopy(credentials)
+      rule = rules[rule_id] if rule_id in rules else rule_executor.get_rule(rule_id=rule_id)
+      apply_dry_run_configuration(
+        rule=rule,
+        args={**args, **rule_args},
+        configure=configure
+      )
+      with channel_rate_limit({**args, **rule_args}, configure, channel=channel):
+        result = rule_executor.execute(
+          credentials=credentials,
+          rule=rule,
+          granularity=rule_args['granularity'],
+          start_date=datetime.strptime(rule_args['startDate'], date_format),
+          end_date=datetime.strptime(rule_args['endDate'], date_format)
+        )
+    except Exception:
+      return {'ruleID': rule_id, 'errors': [traceback.format_exc()]}, False
+    rule_result = {
+      'ruleID': rule_id,
+      'result': result,
+    }
+    if rule_executor.write_failures:
+      rule_result['writeFailures'] = rule_executor.write_failures
+      rule_result['errors'] = write_failure_errors(rule_executor.write_failures)
+    with channel_rate_limit({**args, **rule_args}, configure, channel=channel):
+      refresh_impact_aggregate(
+        rule_executor=rule_executor,
+        credentials=credentials,
+        rule=rule,
+        rule_id=rule_id,
+        since=datetime.strptime(rule_args['startDate'], date_format),
+        configure=configure,
+        command_io=command_io
+      )
+    return rule_result, True
+
+  executed_rule_ids = []
+  failed_rule_ids = []
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    pending = []
+    for group in credential_groups.values():
+      if load_errors is not None:
+        pending.extend(({'ruleID': rule_args['ruleID'], 'errors': load_errors}, False) for rule_args in group)
+        continue
+      try:
+        credentials = prepare_credentials(group[0])
+      except Exception:
+        errors = [traceback.format_exc()]
+        pending.extend(({'ruleID': rule_args['ruleID'], 'errors': errors}, False) for rule_args in group)
+        continue
+      pending.extend(
+        executor.submit(bind_command_io(execute_rule), rule_args, credentials)
+        for rule_args in group
+      )
+
+    for item in pending:
+      rule_result, executed = item if isinstance(item, tuple) else item.result()
+      if executed:
+        executed_rule_ids.append(rule_result['ruleID'])
+        command_io.send({
+          'ruleResult': rule_result,
+        }, cls=RuleSerializer)
+      else:
+        failed_rule_ids.append(rule_result['ruleID'])
+        command_io.send({'ruleResult': rule_result})
+
+  command_io.send({
+    'result': {
+      'executedRuleIDs': executed_rule_ids,
+      'failedRuleIDs': failed_rule_ids,
+    },
+  })
+
+def run_backtest_rule(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  date_format = '%Y-%m-%d'
+  rule_executor = prepare_rule_executor(args, configure)
+  rule_id = args['ruleID']
+  channel = args.get('channel') or rule_executor.get_rule_channels(rule_ids=[rule_id]).get(rule_id)
+  actions = rule_executor.backtest(
+    credentials=prepare_credentials(args),
+    rule_id=rule_id,
+    granularity=args['granularity'],
+    start_date=datetime.strptime(args['startDate'], date_format),
+    end_date=datetime.strptime(args['endDate'], date_format),
+    window_days=args.get('windowDays', 1),
+    step_days=args.get('stepDays'),
+    processes=args.get('processes', configure.get('backtest_processes')),
+    rate_limit={
+      'channel': channel,
+      'credentials_fingerprint': credentials_fingerprint(args['credentials']),
+      'buckets': configure.get('rate_limits', {}),
+    }
+  )
+  command_io.send_json(f'{{"result":{{"ruleID": {json.dumps(rule_id)}, "actions": {actions.to_json(orient="records", date_format="iso", default_handler=str)}}}}}')
+
+def run_impact_report(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from .map_manifest import register_map_identifiers
+  from .impact_store import impact_granularity
+  register_map_identifiers()
+  credentials = prepare_credentials(args)
+  rule_id = args['ruleID']
+  report_id = args['reportID']
+  page_size = args.get('pageSize')
+
+  rule_executor = prepare_rule_executor(args, configure)
+  rule = rule_executor.get_rule(rule_id=rule_id)
+  channel = args.get('channel') or rule_executor.get_rule_channels(rule_ids=[rule_id]).get(rule_id)
+  with channel_rate_limit(args, configure, channel=channel):
     report_metadata = rule_executor.get_impact_report_metadata(
       credentials=credentials,
-      rule=rule
+      rule=rule,
+      rule_id=rule_id
     )
 
-    print(json.dumps({'result': {'reportId': report_id, 'granularity': report_metadata.granularity.value}}))
-    if report_metadata.is_valid:
+  command_io.send({'result': {'reportId': report_id, 'granularity': impact_granularity(metadata=report_metadata)}})
+  if page_size:
+    from .report_output import send_record_pages, should_continue
+    if not should_continue(command_io.receive()) or not report_metadata.is_valid:
+      return
+    with channel_rate_limit(args, configure, channel=channel):
       report = rule_executor.get_impact_report(
         credentials=credentials,
-        rule=rule
+        rule=rule,
+        rule_id=rule_id,
+        metadata=report_metadata
       )
-      print(f'{{"result":{{"reportId": "{report_id}", "rows": {report.to_json(orient="records")}}}}}')
-
-    input()
-  
-  elif command is Command.channel_report:
-    fetcher = ChannelPerformanceFetcher(
-      raw_channel=args['channel'],
-      raw_time_granularity=args['time_granularity'],
-      raw_entity_granularity=args['entity_granularity'],
-      raw_performance_columns=[]
-    )
-    start = datetime.fromtimestamp(args['start'])
-    end = datetime.fromtimestamp(args['end'])
-    report = fetcher.run(
-      credentials=prepare_credentials(args),
-      start=start,
-      end=end
+    send_record_pages(
+      report=report,
+      command_io=command_io,
+      page_size=page_size,
+      page_message=lambda rows, progress: f'{{"result":{{"reportId": {json.dumps(report_id)}, "progress": {progress}, "rows": {rows}}}}}'
+    )
+    return
+
+  if report_metadata.is_valid:
+    with channel_rate_limit(args, configure, channel=channel):
+      report = rule_executor.get_impact_report(
+        credentials=credentials,
+        rule=rule,
+        rule_id=rule_id,
+        metadata=report_metadata
+      )
+    command_io.send_json(f'{{"result":{{"reportId": "{report_id}", "rows": {report.to_json(orient="records")}}}}}')
+
+  command_io.receive()
+
+def channel_performance_fetcher(args: Dict[str, any]) -> any:
+  from io_fetch_channel import ChannelPerformanceFetcher
+  return ChannelPerformanceFetcher(
+    raw_channel=args['channel'],
+    raw_time_granularity=args['time_granularity'],
+    raw_entity_granularity=args['entity_granularity'],
+    raw_performance_columns=[]
+  )
+
+def channel_metrics_store(args: Dict[str, any]) -> any:
+  from .metrics_store import MetricsStore
+  return MetricsStore(
+    channel=args['channel'],
+    credentials_fingerprint=credentials_fingerprint(args['credentials']),
+    entity_granularity=args['entity_granularity'],
+    time_granularity=args['time_granularity']
+  )
+
+def fetch_channel_report(args: Dict[str, any], configure: Dict[str, any]) -> any:
+  from .fetch_cache import report_fetch_cache
+  report_fetch_cache.configure(**configure.get('report_fetch_cache', {}))
+  start = datetime.fromtimestamp(args['start'])
+  end = datetime.fromtimestamp(args['end'])
+  stored_report = None
+  if args.get('metrics_store') and start.time() == end.time() == datetime.min.time():
+    metrics_store = channel_metrics_store(args)
+    fresh_until = metrics_store.fresh_until(
+      start=start.date(),
+      end=end.date(),
+      max_age=configure.get('metrics_store', {}).get('max_age', 60 * 60)
+    )
+    if fresh_until is not None:
+      stored_report = metrics_store.read(start=start.date(), end=fresh_until)
+      if fresh_until >= end.date():
+        return stored_report
+      start = datetime.combine(fresh_until + timedelta(days=1), datetime.min.time())
+
+  fetcher = channel_performance_fetcher(args)
+  cache_key = report_fetch_cache.key(
+    credentials_fingerprint=credentials_fingerprint(args['credentials']),
+    entity_granularity=args['entity_granularity'],
+    time_granularity=args['time_granularity'],
+    start=start,
+    end=end,
+    channel=args['channel']
+  )
+  def fetch() -> any:
+    credentials = prepare_credentials(args)
+    with channel_rate_limit(args, configure):
+      return fetcher.run(
+        credentials=credentials,
+        start=start,
+        end=end
+      )
+  with span('channel_fetch') as fetch_span:
+    report = report_fetch_cache.get(
+      key=cache_key,
+      fetch=fetch
+    )
+    fetch_span['rows'] = len(report.index)
+  if stored_report is not None:
+    import pandas as pd
+    report = pd.concat([stored_report, report], ignore_index=True)
+  return report
+
+def run_channel_report(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  report = fetch_channel_report(args, configure)
+  if args.get('output_format'):
+    from .report_output import write_report_file, ReportFileFormat
+    command_io.send({
+      'file': write_report_file(
+        report=report,
+        file_format=ReportFileFormat(args['output_format'])
+      ),
+    })
+  elif args.get('stream'):
+    from .report_output import send_csv_chunks, default_chunk_bytes
+    summary = send_csv_chunks(
+      report=report,
+      command_io=command_io,
+      chunk_bytes=args.get('chunk_bytes', default_chunk_bytes)
     )
-    print(json.dumps({
+    command_io.send({
+      'summary': summary,
+    })
+  else:
+    command_io.send({
       'data': report.to_csv(index=False),
-    }))
+    })
+
+def run_metrics_fetch(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from moda import log
+  fetcher = channel_performance_fetcher(args)
+  metrics_store = channel_metrics_store(args)
+  credentials = prepare_credentials(args)
+  end = datetime.fromtimestamp(args['end']).date() if 'end' in args else datetime.utcnow().date()
+  start = datetime.fromtimestamp(args['start']).date() if 'start' in args else end - timedelta(days=args.get('days', 30) - 1)
+  with channel_rate_limit(args, configure):
+    fetched_days = metrics_store.extend(
+      fetch=lambda day_start, day_end: fetcher.run(
+        credentials=credentials,
+        start=day_start,
+        end=day_end
+      ),
+      start=start,
+      end=end,
+      settle_days=args.get('settle_days', 2)
+    )
+  log.log(f'Fetched {len(fetched_days)} of {(end - start).days + 1} days into {metrics_store.path}')
+  command_io.send({
+    'result': {
+      'path': str(metrics_store.path),
+      'fetchedDays': [d.isoformat() for d in fetched_days],
+    },
+  })
 
-  elif command is Command.report:
-    from .report import get_metadata_report
+def run_report(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from .report import get_metadata_report
+  credentials = prepare_credentials(args)
+  with channel_rate_limit(args, configure, channel=args.get('channel', Command.report.value), interactive=True):
     result = get_metadata_report(
       columns=args['columns'],
       filters=args['filters'],
       options=args['options'],
-      credentials=prepare_credentials(args)
+      credentials=credentials
+    )
+  if args.get('outputFormat'):
+    from .report_output import write_report_file, ReportFileFormat
+    command_io.send({
+      'result': {
+        'metadata': result['metadata'],
+        'file': write_report_file(
+          report=result['report'],
+          file_format=ReportFileFormat(args['outputFormat'])
+        ),
+      },
+    })
+  elif args.get('stream'):
+    from .report_output import send_csv_chunks, default_chunk_bytes
+    summary = send_csv_chunks(
+      report=result['report'],
+      command_io=command_io,
+      chunk_bytes=args.get('chunkBytes', default_chunk_bytes)
     )
-    print(json.dumps({
+    command_io.send({
+      'result': {
+        'metadata': result['metadata'],
+        'summary': summary,
+      },
+    })
+  else:
+    command_io.send({
       'result': {
         'metadata': result['metadata'],
         'report': result['report'].to_csv(index=False),
       },
-    }))
+    })
 
-  elif command is Command.entity_process:
-    from .entity import process_entities
-    result = process_entities(
-      operations=args['operations'],
-      context=args['context'],
-      credentials=prepare_credentials(args)
-    )
-    print(json.dumps({
-      'result': result,
-    }))
+def run_entity_process(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from .entity import process_entities
+  from .entity_cache import shared_entity_cache
+  try:
+    credentials = prepare_credentials(args)
+    with channel_rate_limit(args, configure, channel=args.get('channel', Command.entity_process.value)):
+      result = process_entities(
+        operations=args['operations'],
+        context=args['context'],
+        credentials=credentials
+      )
+  finally:
+    entity_cache = shared_entity_cache(ttls=configure.get('entity_cache_ttls', {}))
+    invalidated_credentials = [args['credentials']]
+    if isinstance(args['credentials'], dict):
+      invalidated_credentials.extend(args['credentials'].values())
+    for credentials in invalidated_credentials:
+      entity_cache.invalidate(credentials_fingerprint=credentials_fingerprint(credentials))
+  command_io.send({
+    'result': result,
+  })
 
-  else:
+def run_statistics(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO):
+  from .fetch_cache import report_fetch_cache
+  from .entity_cache import shared_entity_cache
+  from .credential_cache import credential_cache
+  from .rate_limiter import rate_limiter
+  command_io.send({
+    'result': {
+      'reportFetchCache': report_fetch_cache.statistics,
+      'credentialCache': credential_cache.statistics,
+      'entityCache': shared_entity_cache(ttls=configure.get('entity_cache_ttls', {})).statistics,
+      'mongoClientPool': sys.modules['scripts.mongo_pool'].mongo_client_pool.statistics if 'scripts.mongo_pool' in sys.modules else None,
+      'rateLimits': rate_limiter.statistics,
+    },
+  })
+
+command_runners = {
+  Command.orgs: run_orgs,
+  Command.campaigns: run_campaigns,
+  Command.adgroups: run_adgroups,
+  Command.entity_tree: run_entity_tree,
+  Command.execute_rule: run_execute_rule,
+  Command.execute_rules: run_execute_rules,
+  Command.backtest_rule: run_backtest_rule,
+  Command.impact_report: run_impact_report,
+  Command.channel_report: run_channel_report,
+  Command.metrics_fetch: run_metrics_fetch,
+  Command.report: run_report,
+  Command.entity_process: run_entity_process,
+  Command.statistics: run_statistics,
+}
+
+def execute_command(args: Dict[str, any], configure: Dict[str, any], command_io: CommandIO=standard_command_io):
+  command = Command(args['command'])
+  if command not in command_runners:
     raise ValueError('Unsupported command', command)
 
+  metrics = CommandMetrics(command=command.value)
+  previous_command_io = getattr(_command_context, 'command_io', None)
+  _command_context.command_io = command_io
+  try:
+    with measuring(metrics):
+      with span('imports'):
+        import_command_modules(command=command)
+      if args.get('cassette'):
+        from .cassette import channel_cassette
+        with channel_cassette(options=args['cassette']) as cassette:
+          command_runners[command](args, configure, command_io)
+        count('cassetteRequests', cassette.requests)
+      else:
+        command_runners[command](args, configure, command_io)
+  finally:
+    _command_context.command_io = previous_command_io
+    command_io.flush_logs()
+    if args.get('metrics', False):
+      command_io.send({'metrics': metrics.summary})
+
+def close_mongo_clients():
+  if 'scripts.mongo_pool' in sys.modules:
+    sys.modules['scripts.mongo_pool'].mongo_client_pool.close()
+
+def run():
+  global unbound_log_stream
+  args = json.loads(sys.argv[1])
+  from moda import log
+  log.set_message_logger(log_message)
+  configure = load_configure()
+  command = Command(args['command'])
+
+  if command is Command.serve:
+    from .server import CommandServer
+    unbound_log_stream = sys.stderr
+    server = CommandServer(
+      configure=configure,
+      max_workers=args.get('workers', 4)
+    )
+    server.preload()
+    try:
+      if 'socket' in args:
+        server.serve_socket(path=args['socket'])
+      else:
+        server.serve_stream(
+          read_line=sys.stdin.readline,
+          write_line=lambda line: print(line, flush=True)
+        )
+    finally:
+      server.shutdown()
+  else:
+    try:
+      execute_command(
+        args=args,
+        configure=configure
+      )
+    finally:
+      close_mongo_clients()
+
 if __name__ == '__main__':
-  run()
\ No newline at end of file
+  run()
@@ -0,0 +1,202 @@
+import copy
+import threading
+import traceback
+
+from contextlib import nullcontext
+from bson import ObjectId
+from datetime import datetime, timedelta
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult, BulkWriteResult
+from typing import Dict, List, Tuple, Optional
+
+class CapturedCollection:
+  collection: any
+  documents: List[Dict[str, any]]
+  ignored_writes: int
+  _lock: threading.Lock
+
+  def __init__(self, collection: any):
+    self.collection = collection
+    self.documents = []
+    self.ignored_writes = 0
+    self._lock = threading.Lock()
+
+  def _capture(self, documents: List[Dict[str, any]]) -> List[any]:
+    with self._lock:
+      for document in documents:
+        document.setdefault('_id', ObjectId())
+        self.documents.append(copy.deepcopy(document))
+    return [document['_id'] for document in documents]
+
+  def _ignore(self):
+    with self._lock:
+      self.ignored_writes += 1
+
+  def insert_one(self, document: Dict[str, any], *args, **kwargs) -> InsertOneResult:
+    return InsertOneResult(self._capture([document])[0], True)
+
+  def insert_many(self, documents: List[Dict[str, any]], *args, **kwargs) -> InsertManyResult:
+    return InsertManyResult(self._capture(list(documents)), True)
+
+  def insert(self, documents: any, *args, **kwargs) -> any:
+    if isinstance(documents, dict):
+      return self._capture([documents])[0]
+    return self._capture(list(documents))
+
+  def update_one(self, *args, **kwargs) -> UpdateResult:
+    self._ignore()
+    return UpdateResult({'n': 0, 'nModified': 0, 'ok': 1}, True)
+
+  def update_many(self, *args, **kwargs) -> UpdateResult:
+    self._ignore()
+    return UpdateResult({'n': 0, 'nModified': 0, 'ok': 1}, True)
+
+  def replace_one(self, *args, **kwargs) -> UpdateResult:
+    self._ignore()
+    return UpdateResult({'n': 0, 'nModified': 0, 'ok': 1}, True)
+
+  def update(self, *args, **kwargs) -> Dict[str, any]:
+    self._ignore()
+    return {'n': 0, 'nModified': 0, 'ok': 1}
+
+  def delete_one(self, *args, **kwargs) -> DeleteResult:
+    self._ignore()
+    return DeleteResult({'n': 0, 'ok': 1}, True)
+
+  def delete_many(self, *args, **kwargs) -> DeleteResult:
+    self._ignore()
+    return DeleteResult({'n': 0, 'ok': 1}, True)
+
+  def bulk_write(self, *args, **kwargs) -> BulkWriteResult:
+    self._ignore()
+    return BulkWriteResult({'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}, True)
+
+  def find_one_and_update(self, filter: Dict[str, any], *args, **kwargs) -> Optional[Dict[str, any]]:
+    self._ignore()
+    return self.collection.find_one(filter)
+
+  def __getattr__(self, name: str) -> any:
+    return getattr(self.collection, name)
+
+report_date_columns = ['date', 'day']
+
+class SlicedReportFetch:
+  start_date: datetime
+  end_date: datetime
+  fetches: int
+  slices: int
+  _reports: Dict[Tuple[any, ...], Optional[Tuple[any, any, str]]]
+
+  def __init__(self, start_date: datetime, end_date: datetime):
+    self.start_date = start_date
+    self.end_date = end_date
+    self.fetches = 0
+    self.slices = 0
+    self._reports = {}
+
+  def fetch(self, fetch_raw_report: any, reporter: any, startDate: datetime, endDate: datetime, granularity: any, api: any, campaign: any, adGroupIDs: Optional[List[any]]=None) -> any:
+    import pandas as pd
+    def fetch_window() -> any:
+      return fetch_raw_report(reporter, startDate=startDate, endDate=endDate, granularity=granularity, api=api, campaign=campaign, adGroupIDs=adGroupIDs)
+    if startDate < self.start_date or endDate > self.end_date:
+      return fetch_window()
+    key = (str(getattr(reporter, 'reportType', None)), str(granularity), str(getattr(campaign, '_id', campaign)), tuple(adGroupIDs) if adGroupIDs else None)
+    if key not in self._reports:
+      self._reports[key] = None
+      try:
+        result = fetch_raw_report(reporter, startDate=self.start_date, endDate=self.end_date, granularity=granularity, api=api, campaign=campaign, adGroupIDs=adGroupIDs)
+        self.fetches += 1
+        report = getattr(reporter, 'rawReport', None)
+        date_column = next((c for c in report_date_columns if c in report.columns), None) if isinstance(report, pd.DataFrame) else None
+        if date_column is not None:
+          self._reports[key] = (result, report, date_column)
+      except Exception:
+        from moda import log
+        log.log(f'Falling back to per-window report fetches for {key}:\n{traceback.format_exc()}')
+    if self._reports[key] is None:
+      return fetch_window()
+    result, report, date_column = self._reports[key]
+    dates = pd.to_datetime(report[date_column])
+    reporter.rawReport = report[(dates >= startDate) & (dates < endDate + timedelta(days=1))].reset_index(drop=True)
+    self.slices += 1
+    return result
+
+def install_sliced_report_fetch(start_date: datetime, end_date: datetime) -> Optional[SlicedReportFetch]:
+  try:
+    from regla.models.report_models import SearchAdsReporter
+  except ImportError:
+    return None
+  sliced_fetch = SlicedReportFetch(start_date=start_date, end_date=end_date)
+  fetch_raw_report = getattr(SearchAdsReporter.fetchRawReport, 'unsliced', SearchAdsReporter.fetchRawReport)
+  def sliced_fetch_raw_report(reporter: any, *args, **kwargs) -> any:
+    return sliced_fetch.fetch(fetch_raw_report, reporter, *args, **kwargs)
+  sliced_fetch_raw_report.unsliced = fetch_raw_report
+  SearchAdsReporter.fetchRawReport = sliced_fetch_raw_report
+  return sliced_fetch
+
+def backtest_windows(start_date: datetime, end_date: datetime, window_days: int=1, step_days: Optional[int]=None) -> List[Tuple[datetime, datetime]]:
+  if window_days < 1:
+    raise ValueError(f'Backtest windows must span at least one day, got {window_days}')
+  if step_days is not None and step_days < 1:
+    raise ValueError(f'Backtest windows must advance by at least one day, got {step_days}')
+  window = timedelta(days=window_days - 1)
+  step = timedelta(days=step_days if step_days is not None else window_days)
+  windows = []
+  window_start = start_date
+  while window_start + window <= end_date:
+    windows.append((window_start, window_start + window))
+    window_start += step
+  return windows
+
+_worker: Dict[str, any] = {}
+
+def initialize_backtest_worker(options: Dict[str, any], rule_id: str, rule_documents: List[Dict[str, any]], condition_groups: List[Dict[str, any]], credentials: any, granularity: str, rate_limit: Optional[Dict[str, any]], database_configuration: Optional[Dict[str, any]]=None, report_range: Optional[Tuple[datetime, datetime]]=None):
+  from .map_manifest import register_map_identifiers
+  from .rule_executor import RuleExecutor
+  register_map_identifiers()
+  if report_range is not None:
+    install_sliced_report_fetch(start_date=report_range[0], end_date=report_range[1])
+  database = None
+  if database_configuration is not None:
+    from data_layer import Mongo as SQL
+    SQL.Layer.configure_connection(database_configuration)
+    layer = SQL.Layer()
+    layer.connect()
+    database = layer.get_database()
+  _worker.update(
+    rule_executor=RuleExecutor(options=options, database=database),
+    rule_id=rule_id,
+    rule_documents=rule_documents,
+    condition_groups=condition_groups,
+    credentials=credentials,
+    granularity=granularity,
+    rate_limit=rate_limit
+  )
+
+def run_backtest_window(window: Tuple[datetime, datetime]) -> List[Dict[str, any]]:
+  from regla.models.rule_model import Rule
+  from .rule_loader import PrefetchedCollection
+  from .rate_limiter import rate_limiter, install_http_rate_limit
+  rule_executor = _worker['rule_executor']
+  rule = Rule.ruleWithID(
+    rulesCollection=PrefetchedCollection(collection=rule_executor.rulesCollection, documents=copy.deepcopy(_worker['rule_documents'])),
+    conditionGroupsCollection=PrefetchedCollection(collection=rule_executor.conditionGroupsCollection, documents=copy.deepcopy(_worker['condition_groups'])),
+    id=_worker['rule_id']
+  )
+  if _worker['rate_limit'] is not None:
+    install_http_rate_limit()
+  with rate_limiter.limit(**_worker['rate_limit'], interactive=False) if _worker['rate_limit'] is not None else nullcontext():
+    actions = rule_executor.dry_run(
+      credentials=copy.deepcopy(_worker['credentials']),
+      rule=rule,
+      granularity=_worker['granularity'],
+      start_date=window[0],
+      end_date=window[1]
+    )
+  return [
+    {
+      'windowStart': window[0],
+      'windowEnd': window[1],
+      **{k: v for k, v in action.items() if k != '_id'},
+    }
+    for action in actions
+  ]
@@ -0,0 +1,256 @@
+import io
+import json
+import gzip
+import time
+import base64
+import hashlib
+import threading
+
+from pathlib import Path
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from typing import Dict, List, Tuple, Union, Optional
+
+cassette_version = 1
+cassette_path = Path(__file__).parent.parent / 'output' / 'cassettes'
+unrecorded_response_headers = {'content-encoding', 'content-length', 'transfer-encoding', 'set-cookie', 'authorization', 'www-authenticate', 'proxy-authenticate'}
+redacted_body_keys = {'access_token', 'refresh_token', 'id_token', 'client_secret', 'client_assertion', 'assertion', 'token', 'password'}
+redacted_value = 'REDACTED'
+
+def redact(value: any) -> Tuple[any, bool]:
+  if isinstance(value, dict):
+    redacted = False
+    items = {}
+    for k, v in value.items():
+      if isinstance(k, str) and k.lower() in redacted_body_keys:
+        items[k] = redacted_value
+        redacted = True
+      else:
+        items[k], item_redacted = redact(v)
+        redacted = redacted or item_redacted
+    return items, redacted
+  if isinstance(value, list):
+    values = [redact(v) for v in value]
+    return [v for v, _ in values], any(r for _, r in values)
+  return value, False
+
+def redact_text(text: str) -> str:
+  if not any(k in text for k in redacted_body_keys):
+    return text
+  try:
+    contents = json.loads(text)
+  except ValueError:
+    return text
+  contents, redacted = redact(contents)
+  return json.dumps(contents) if redacted else text
+
+def request_url(url: str) -> Tuple[str, str]:
+  parts = urlsplit(url)
+  path = urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+  return path, urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True))), ''))
+
+def request_body_hash(body: any) -> str:
+  if body is None:
+    body = b''
+  elif isinstance(body, str):
+    body = body.encode()
+  elif not isinstance(body, (bytes, bytearray)):
+    body = str(body).encode()
+  return hashlib.sha256(body).hexdigest()
+
+def request_keys(method: str, url: str, body: any) -> Tuple[str, str]:
+  path, normalized_url = request_url(url=url)
+  return (
+    hashlib.sha256(f'{method} {normalized_url} {request_body_hash(body=body)}'.encode()).hexdigest(),
+    f'{method} {path}',
+  )
+
+class Cassette:
+  path: Path
+  interactions: List[Dict[str, any]]
+  recorded: Optional[str]
+
+  def __init__(self, path: Path, interactions: List[Dict[str, any]]=[], recorded: Optional[str]=None):
+    self.path = path
+    self.interactions = list(interactions)
+    self.recorded = recorded
+
+  @classmethod
+  def load(cls, path: Path) -> 'Cassette':
+    with gzip.open(str(path), 'rt') as f:
+      contents = json.load(f)
+    if contents.get('version') != cassette_version:
+      raise ValueError(f'Cassette {path} has version {contents.get("version")}, expected version {cassette_version}; record it again')
+    return cls(
+      path=path,
+      interactions=contents['interactions'],
+      recorded=contents['recorded']
+    )
+
+  def save(self):
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = self.path.with_name(f'.{self.path.name}.tmp')
+    with gzip.open(str(temporary_path), 'wt') as f:
+      json.dump({
+        'version': cassette_version,
+        'recorded': self.recorded or datetime.utcnow().isoformat(),
+        'interactions': self.interactions,
+      }, f)
+    temporary_path.replace(self.path)
+
+  @property
+  def requests(self) -> int:
+    return len(self.interactions)
+
+  def record(self, request: any, response: any, elapsed: float):
+    key, route = request_keys(method=request.method, url=request.url, body=request.body)
+    content = response.content
+    try:
+      body = {'text': redact_text(content.decode('utf-8'))}
+    except UnicodeDecodeError:
+      body = {'base64': base64.b64encode(content).decode()}
+    self.interactions.append({
+      'key': key,
+      'route': route,
+      'status': response.status_code,
+      'reason': response.reason,
+      'headers': {k: v for k, v in response.headers.items() if k.lower() not in unrecorded_response_headers},
+      'elapsed': elapsed,
+      **body,
+    })
+
+class CassettePlayer:
+  cassette: Cassette
+  latency: Optional[Union[float, str]]
+  requests: int
+  fuzzy_matches: int
+  latency_seconds: float
+  _interactions: Dict[str, List[Dict[str, any]]]
+  _routes: Dict[str, List[Dict[str, any]]]
+  _lock: threading.Lock
+
+  def __init__(self, cassette: Cassette, latency: Optional[Union[float, str]]=None):
+    self.cassette = cassette
+    self.latency = latency
+    self.requests = 0
+    self.fuzzy_matches = 0
+    self.latency_seconds = 0
+    self._interactions = {}
+    self._routes = {}
+    self._lock = threading.Lock()
+    for interaction in cassette.interactions:
+      self._interactions.setdefault(interaction['key'], []).append(interaction)
+      self._routes.setdefault(interaction['route'], []).append(interaction)
+
+  def _take(self, queues: Dict[str, List[Dict[str, any]]], key: str) -> Optional[Dict[str, any]]:
+    queue = queues.get(key)
+    if not queue:
+      return None
+    return queue.pop(0) if len(queue) > 1 else queue[0]
+
+  def interaction(self, request: any) -> Dict[str, any]:
+    key, route = request_keys(method=request.method, url=request.url, body=request.body)
+    with self._lock:
+      self.requests += 1
+      interaction = self._take(queues=self._interactions, key=key)
+      if interaction is None:
+        interaction = self._take(queues=self._routes, key=route)
+        if interaction is None:
+          raise LookupError(f'No recorded response for {route} in cassette {self.cassette.path}')
+        self.fuzzy_matches += 1
+    return interaction
+
+  def play(self, request: any) -> any:
+    from requests.models import Response
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+    interaction = self.interaction(request=request)
+    delay = interaction['elapsed'] if self.latency == 'recorded' else self.latency
+    if delay:
+      time.sleep(delay)
+      with self._lock:
+        self.latency_seconds += delay
+    content = interaction['text'].encode('utf-8') if 'text' in interaction else base64.b64decode(interaction['base64'])
+    response = Response()
+    response.status_code = interaction['status']
+    response.reason = interaction['reason']
+    response.headers = CaseInsensitiveDict(interaction['headers'])
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.url = request.url
+    response.request = request
+    response.elapsed = timedelta(seconds=delay or 0)
+    response.raw = io.BytesIO(content)
+    response._content = content
+    response._content_consumed = True
+    return response
+
+  @property
+  def statistics(self) -> Dict[str, any]:
+    with self._lock:
+      return {
+        'requests': self.requests,
+        'fuzzyMatches': self.fuzzy_matches,
+        'latencySeconds': self.latency_seconds,
+      }
+
+_cassette_context = threading.local()
+_install_lock = threading.Lock()
+_installed = False
+
+def current_cassette() -> Optional[Union[Cassette, CassettePlayer]]:
+  return getattr(_cassette_context, 'active', None)
+
+def install_cassette_hook():
+  global _installed
+  from requests.adapters import HTTPAdapter
+  with _install_lock:
+    if _installed:
+      return
+    _installed = True
+  send = HTTPAdapter.send
+  def cassette_send(adapter: HTTPAdapter, request: any, *args, **kwargs) -> any:
+    active = current_cassette()
+    if isinstance(active, CassettePlayer):
+      return active.play(request=request)
+    start = time.perf_counter()
+    response = send(adapter, request, *args, **kwargs)
+    if isinstance(active, Cassette):
+      elapsed = time.perf_counter() - start
+      with _install_lock:
+        active.record(request=request, response=response, elapsed=elapsed)
+    return response
+  cassette_send.rate_limited = getattr(send, 'rate_limited', False)
+  HTTPAdapter.send = cassette_send
+
+@contextmanager
+def using(active: Optional[Union[Cassette, CassettePlayer]]):
+  if active is not None:
+    install_cassette_hook()
+  previous_active = current_cassette()
+  _cassette_context.active = active
+  try:
+    yield active
+  finally:
+    _cassette_context.active = previous_active
+
+@contextmanager
+def recording(path: Path):
+  cassette = Cassette(path=path)
+  with using(active=cassette):
+    yield cassette
+  cassette.save()
+
+@contextmanager
+def replaying(path: Path, latency: Optional[Union[float, str]]=None):
+  with using(active=CassettePlayer(cassette=Cassette.load(path=path), latency=latency)) as player:
+    yield player
+
+def channel_cassette(options: Dict[str, any]) -> any:
+  path = Path(options['path'])
+  if not path.is_absolute():
+    path = cassette_path / path
+  if options.get('mode', 'replay') == 'record':
+    return recording(path=path)
+  latency = options.get('latency')
+  return replaying(path=path, latency=latency if latency in (None, 'recorded') else float(latency))
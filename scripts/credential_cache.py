@@ -0,0 +1,101 @@
+import copy
+import time
+import threading
+
+from collections import OrderedDict
+from typing import Dict, Callable, Optional
+
+def scrub(value: any):
+  if isinstance(value, dict):
+    for item in value.values():
+      scrub(item)
+    value.clear()
+  elif isinstance(value, list):
+    for item in value:
+      scrub(item)
+    value.clear()
+  elif isinstance(value, bytearray):
+    value[:] = bytes(len(value))
+
+class CredentialCache:
+  ttl: float
+  max_entries: int
+  hits: int
+  misses: int
+  evictions: int
+  resolve_seconds: float
+  _entries: OrderedDict
+  _lock: threading.Lock
+
+  def __init__(self, ttl: float=600, max_entries: int=16):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.resolve_seconds = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def configure(self, ttl: Optional[float]=None, max_entries: Optional[int]=None):
+    with self._lock:
+      if ttl is not None:
+        self.ttl = ttl
+      if max_entries is not None:
+        self.max_entries = max_entries
+      self._evict(now=time.monotonic())
+
+  def _evict(self, now: float):
+    for fingerprint in [f for f, (expires, _) in self._entries.items() if expires <= now]:
+      scrub(self._entries.pop(fingerprint)[1])
+      self.evictions += 1
+    while len(self._entries) > self.max_entries:
+      scrub(self._entries.popitem(last=False)[1][1])
+      self.evictions += 1
+
+  def resolve(self, fingerprint: str, resolve: Callable[[], any]) -> any:
+    with self._lock:
+      now = time.monotonic()
+      self._evict(now=now)
+      entry = self._entries.get(fingerprint)
+      if entry is not None:
+        self._entries.move_to_end(fingerprint)
+        self.hits += 1
+        return copy.deepcopy(entry[1])
+      self.misses += 1
+
+    start = time.monotonic()
+    credentials = resolve()
+    with self._lock:
+      self.resolve_seconds += time.monotonic() - start
+      if self.ttl <= 0 or self.max_entries <= 0:
+        return credentials
+      try:
+        cached_credentials = copy.deepcopy(credentials)
+      except Exception:
+        return credentials
+      if fingerprint in self._entries:
+        scrub(self._entries.pop(fingerprint)[1])
+      self._entries[fingerprint] = (time.monotonic() + self.ttl, cached_credentials)
+      self._evict(now=time.monotonic())
+    return credentials
+
+  def clear(self):
+    with self._lock:
+      while self._entries:
+        scrub(self._entries.popitem()[1][1])
+
+  @property
+  def statistics(self) -> Dict[str, any]:
+    with self._lock:
+      requests = self.hits + self.misses
+      return {
+        'entries': len(self._entries),
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hitRate': self.hits / requests if requests else None,
+        'averageResolveSeconds': self.resolve_seconds / self.misses if self.misses else None,
+      }
+
+credential_cache = CredentialCache()
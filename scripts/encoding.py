@@ -0,0 +1,19 @@
+import json
+
+from typing import Dict, Optional
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+orjson_options = 0 if orjson is None else orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+def encode_message(message: Dict[str, any], cls: Optional[type]=None, fast: bool=True) -> str:
+  if not fast or orjson is None:
+    return json.dumps(message, cls=cls)
+  fallback = (cls or json.JSONEncoder)()
+  try:
+    return orjson.dumps(message, default=fallback.default, option=orjson_options).decode()
+  except orjson.JSONEncodeError:
+    return json.dumps(message, cls=cls)
@@ -0,0 +1,110 @@
+import json
+import time
+import sqlite3
+
+from pathlib import Path
+from contextlib import closing
+from typing import Dict, List, Callable, Optional
+
+entity_cache_path = Path(__file__).parent.parent / 'output' / 'state' / 'entity_cache.sqlite3'
+
+default_entity_ttls = {
+  'org': 24 * 60 * 60,
+  'campaign': 60 * 60,
+  'ad_group': 30 * 60,
+  'keyword': 10 * 60,
+}
+
+class EntityCache:
+  path: Path
+  ttls: Dict[str, float]
+
+  def __init__(self, path: Path=entity_cache_path, ttls: Dict[str, float]={}):
+    self.path = path
+    self.ttls = {**default_entity_ttls, **ttls}
+    with closing(self.connect()) as connection, connection:
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('''
+        CREATE TABLE IF NOT EXISTS entities (
+          channel TEXT NOT NULL,
+          credentials TEXT NOT NULL,
+          level TEXT NOT NULL,
+          parent_key TEXT NOT NULL,
+          fetched REAL NOT NULL,
+          entities TEXT NOT NULL,
+          PRIMARY KEY (channel, credentials, level, parent_key)
+        )
+      ''')
+      connection.execute('''
+        CREATE TABLE IF NOT EXISTS statistics (
+          level TEXT PRIMARY KEY,
+          hits INTEGER NOT NULL DEFAULT 0,
+          misses INTEGER NOT NULL DEFAULT 0,
+          invalidations INTEGER NOT NULL DEFAULT 0
+        )
+      ''')
+
+  def connect(self) -> sqlite3.Connection:
+    return sqlite3.connect(str(self.path), timeout=30)
+
+  @staticmethod
+  def parent_key(parent_ids: Optional[Dict[any, str]]) -> str:
+    if not parent_ids:
+      return ''
+    return json.dumps({getattr(k, 'name', str(k)): str(v) for k, v in parent_ids.items()}, sort_keys=True)
+
+  def _count(self, connection: sqlite3.Connection, level: str, column: str, count: int=1):
+    connection.execute('INSERT OR IGNORE INTO statistics (level) VALUES (?)', (level,))
+    connection.execute(f'UPDATE statistics SET {column} = {column} + ? WHERE level = ?', (count, level))
+
+  def get_entities(self, channel: str, credentials_fingerprint: str, level: str, parent_ids: Optional[Dict[any, str]], fetch: Callable[[], List[Dict[str, any]]], refresh: bool=False) -> List[Dict[str, any]]:
+    key = (channel, credentials_fingerprint, level, self.parent_key(parent_ids=parent_ids))
+    with closing(self.connect()) as connection, connection:
+      row = connection.execute(
+        'SELECT fetched, entities FROM entities WHERE channel = ? AND credentials = ? AND level = ? AND parent_key = ?',
+        key
+      ).fetchone()
+      if row is not None and not refresh and time.time() - row[0] < self.ttls.get(level, 0):
+        self._count(connection=connection, level=level, column='hits')
+        return json.loads(row[1])
+
+    entities = fetch()
+    with closing(self.connect()) as connection, connection:
+      connection.execute(
+        'INSERT OR REPLACE INTO entities (channel, credentials, level, parent_key, fetched, entities) VALUES (?, ?, ?, ?, ?, ?)',
+        (*key, time.time(), json.dumps(entities, default=str))
+      )
+      self._count(connection=connection, level=level, column='misses')
+    return entities
+
+  def invalidate(self, credentials_fingerprint: str, channel: Optional[str]=None):
+    with closing(self.connect()) as connection, connection:
+      condition = 'credentials = ?' if channel is None else 'credentials = ? AND channel = ?'
+      parameters = (credentials_fingerprint,) if channel is None else (credentials_fingerprint, channel)
+      levels = connection.execute(f'SELECT level, COUNT(*) FROM entities WHERE {condition} GROUP BY level', parameters).fetchall()
+      connection.execute(f'DELETE FROM entities WHERE {condition}', parameters)
+      for level, count in levels:
+        self._count(connection=connection, level=level, column='invalidations', count=count)
+
+  @property
+  def statistics(self) -> Dict[str, Dict[str, any]]:
+    with closing(self.connect()) as connection:
+      rows = connection.execute('SELECT level, hits, misses, invalidations FROM statistics').fetchall()
+    return {
+      level: {
+        'hits': hits,
+        'misses': misses,
+        'invalidations': invalidations,
+        'hitRate': hits / (hits + misses) if hits + misses else None,
+        'ttl': self.ttls.get(level),
+      }
+      for level, hits, misses, invalidations in rows
+    }
+
+_shared_entity_cache: Optional[EntityCache] = None
+
+def shared_entity_cache(ttls: Dict[str, float]={}) -> EntityCache:
+  global _shared_entity_cache
+  if _shared_entity_cache is None:
+    _shared_entity_cache = EntityCache(ttls=ttls)
+  return _shared_entity_cache
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Tuple, Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+report_fetch_cache_path = Path(__file__).parent.parent / 'output' / 'state' / 'report_fetch_cache'
+
+def remove_file(path: Path):
+  try:
+    path.unlink()
+  except FileNotFoundError:
+    pass
+
+class _Flight:
+  event: threading.Event
+  value: any
+  error: Optional[BaseException]
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.value = None
+    self.error = None
+
+class FetchCache:
+  ttl: float
+  max_entries: int
+  path: Optional[Path]
+  max_disk_bytes: int
+  hits: int
+  disk_hits: int
+  misses: int
+  coalesced: int
+  evictions: int
+  disk_write_failures: int
+  _entries: OrderedDict
+  _flights: Dict[str, _Flight]
+  _lock: threading.Lock
+
+  def __init__(self, ttl: float=300, max_entries: int=32, path: Optional[Path]=None, max_disk_bytes: int=512 * 1024 * 1024):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.path = path
+    self.max_disk_bytes = max_disk_bytes
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.coalesced = 0
+    self.evictions = 0
+    self.disk_write_failures = 0
+    self._entries = OrderedDict()
+    self._flights = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key(credentials_fingerprint: str, entity_granularity: str, time_granularity: str, start: any, end: any, **extras: any) -> str:
+    key_components = {
+      'credentials': credentials_fingerprint,
+      'entity_granularity': entity_granularity,
+      'time_granularity': time_granularity,
+      'start': start,
+      'end': end,
+      **extras,
+    }
+    return hashlib.sha256(json.dumps(key_components, sort_keys=True, default=str).encode()).hexdigest()
+
+  @staticmethod
+  def _copy(value: T) -> T:
+    return value.copy() if hasattr(value, 'copy') else value
+
+  def configure(self, ttl: Optional[float]=None, max_entries: Optional[int]=None, disk: Optional[bool]=None, path: Optional[str]=None, max_disk_bytes: Optional[int]=None):
+    with self._lock:
+      if ttl is not None:
+        self.ttl = ttl
+      if max_entries is not None:
+        self.max_entries = max_entries
+      if disk is not None:
+        self.path = (Path(path) if path is not None else report_fetch_cache_path) if disk else None
+      if max_disk_bytes is not None:
+        self.max_disk_bytes = max_disk_bytes
+      self._evict(now=time.monotonic())
+
+  def _disk_path(self, key: str) -> Optional[Path]:
+    return self.path / f'{key}.parquet' if self.path is not None and self.ttl > 0 else None
+
+  def _read_disk(self, key: str) -> Tuple[any, float]:
+    import pandas as pd
+    path = self._disk_path(key=key)
+    if path is None:
+      return None, 0
+    try:
+      age = time.time() - path.stat().st_mtime
+      if age >= self.ttl:
+        return None, 0
+      return pd.read_parquet(str(path)), age
+    except OSError:
+      return None, 0
+
+  def _write_disk(self, key: str, value: any):
+    import pandas as pd
+    path = self._disk_path(key=key)
+    if path is None or not isinstance(value, pd.DataFrame):
+      return
+    temp_path = path.with_name(f'.{key}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+      path.parent.mkdir(parents=True, exist_ok=True)
+      value.to_parquet(str(temp_path))
+      os.replace(str(temp_path), str(path))
+      self._evict_disk()
+    except Exception:
+      with self._lock:
+        self.disk_write_failures += 1
+      remove_file(path=temp_path)
+
+  def _evict_disk(self):
+    now = time.time()
+    entries = []
+    for entry_path in self.path.glob('*.parquet'):
+      try:
+        stat = entry_path.stat()
+      except FileNotFoundError:
+        continue
+      if now - stat.st_mtime >= self.ttl:
+        remove_file(path=entry_path)
+      else:
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+      if total_bytes <= self.max_disk_bytes:
+        break
+      remove_file(path=entry_path)
+      total_bytes -= size
+
+  def _evict(self, now: float):
+    for key in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+      del self._entries[key]
+      self.evictions += 1
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+      self.evictions += 1
+
+  def get(self, key: str, fetch: Callable[[], T]) -> T:
+    with self._lock:
+      now = time.monotonic()
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] > now:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._copy(entry[1])
+      flight = self._flights.get(key)
+      if flight is not None:
+        self.coalesced += 1
+        is_leader = False
+      else:
+        flight = _Flight()
+        self._flights[key] = flight
+        is_leader = True
+
+    if not is_leader:
+      flight.event.wait()
+      if flight.error is not None:
+        raise flight.error
+      return self._copy(flight.value)
+
+    try:
+      flight.value, age = self._read_disk(key=key)
+      with self._lock:
+        if flight.value is not None:
+          self.disk_hits += 1
+        else:
+          self.misses += 1
+      if flight.value is None:
+        flight.value = fetch()
+        self._write_disk(key=key, value=flight.value)
+    except BaseException as e:
+      flight.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key]
+        if flight.error is None and self.ttl > 0 and self.max_entries > 0:
+          now = time.monotonic()
+          self._entries[key] = (now + self.ttl - age, flight.value)
+          self._entries.move_to_end(key)
+          self._evict(now=now)
+      flight.event.set()
+    return self._copy(flight.value)
+
+  def invalidate(self, key: Optional[str]=None):
+    with self._lock:
+      if key is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(key, None)
+    if self.path is not None:
+      for entry_path in self.path.glob('*.parquet') if key is None else [self.path / f'{key}.parquet']:
+        remove_file(path=entry_path)
+
+  @property
+  def statistics(self) -> Dict[str, any]:
+    with self._lock:
+      requests = self.hits + self.disk_hits + self.misses + self.coalesced
+      return {
+        'entries': len(self._entries),
+        'diskEntries': len(list(self.path.glob('*.parquet'))) if self.path is not None and self.path.exists() else None,
+        'hits': self.hits,
+        'diskHits': self.disk_hits,
+        'misses': self.misses,
+        'coalesced': self.coalesced,
+        'evictions': self.evictions,
+        'diskWriteFailures': self.disk_write_failures,
+        'hitRate': (self.hits + self.disk_hits + self.coalesced) / requests if requests else None,
+      }
+
+report_fetch_cache = FetchCache()
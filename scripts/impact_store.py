@@ -0,0 +1,130 @@
+import json
+import hashlib
+import pandas as pd
+
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, UpdateOne, DeleteMany
+from typing import Dict, List, Set, Tuple, Optional
+
+default_impact_collection = 'rulesImpact'
+impact_date_columns = ['date', 'day', 'start_date', 'startDate']
+metadata_day = ''
+
+class StoredImpactReportMetadata:
+  granularity: str
+  is_valid: bool
+  updated: datetime
+
+  def __init__(self, granularity: str, is_valid: bool, updated: datetime):
+    self.granularity = granularity
+    self.is_valid = is_valid
+    self.updated = updated
+
+def impact_granularity(metadata: any) -> str:
+  return metadata.granularity if isinstance(metadata.granularity, str) else metadata.granularity.value
+
+class ImpactStore:
+  collection: any
+  max_age: Optional[timedelta]
+  _indexed_collections: Set[str] = set()
+
+  def __init__(self, collection: any, max_age: Optional[float]=24 * 60 * 60):
+    self.collection = collection
+    self.max_age = timedelta(seconds=max_age) if max_age is not None else None
+
+  def ensure_indexes(self):
+    if self.collection.full_name in ImpactStore._indexed_collections:
+      return
+    self.collection.create_index([('ruleID', ASCENDING), ('day', ASCENDING)], unique=True)
+    ImpactStore._indexed_collections.add(self.collection.full_name)
+
+  @staticmethod
+  def day_rows(report: pd.DataFrame) -> Dict[str, List[Dict[str, any]]]:
+    records = json.loads(report.to_json(orient='records'))
+    date_column = next((c for c in impact_date_columns if c in report.columns), None)
+    if date_column is None:
+      return {'all': records} if records else {}
+    days = pd.to_datetime(report[date_column], errors='coerce').dt.strftime('%Y-%m-%d').fillna('unknown')
+    rows = {}
+    for day, record in zip(days, records):
+      rows.setdefault(day, []).append(record)
+    return rows
+
+  def write(self, rule_id: str, granularity: str, is_valid: bool, report: Optional[pd.DataFrame], since: Optional[str]=None) -> Dict[str, int]:
+    self.ensure_indexes()
+    now = datetime.utcnow()
+    day_rows = self.day_rows(report=report) if is_valid and report is not None else {}
+    day_condition = {'$ne': metadata_day}
+    if since is not None and is_valid:
+      day_rows = {d: r for d, r in day_rows.items() if d >= since}
+      day_condition = {'$gte': since}
+    existing_hashes = {
+      d['day']: d.get('hash')
+      for d in self.collection.find({'ruleID': rule_id, 'day': day_condition}, {'day': 1, 'hash': 1})
+    }
+    operations = [
+      UpdateOne(
+        {'ruleID': rule_id, 'day': metadata_day},
+        {'$set': {
+          'granularity': granularity,
+          'isValid': is_valid,
+          'columns': list(report.columns) if report is not None else [],
+          'updated': now,
+        }},
+        upsert=True
+      ),
+    ]
+    changed_days = 0
+    for day, rows in day_rows.items():
+      rows_hash = hashlib.sha256(json.dumps(rows, sort_keys=True).encode()).hexdigest()
+      if existing_hashes.get(day) == rows_hash:
+        continue
+      changed_days += 1
+      operations.append(UpdateOne(
+        {'ruleID': rule_id, 'day': day},
+        {'$set': {'rows': rows, 'hash': rows_hash, 'updated': now}},
+        upsert=True
+      ))
+    removed_days = [d for d in existing_hashes if d not in day_rows]
+    if removed_days:
+      operations.append(DeleteMany({'ruleID': rule_id, 'day': {'$in': removed_days}}))
+    self.collection.bulk_write(operations, ordered=False)
+    return {
+      'days': len(day_rows),
+      'changedDays': changed_days,
+      'removedDays': len(removed_days),
+    }
+
+  def _metadata(self, document: Optional[Dict[str, any]]) -> Optional[StoredImpactReportMetadata]:
+    if document is None or document['day'] != metadata_day:
+      return None
+    if self.max_age is not None and datetime.utcnow() - document['updated'] > self.max_age:
+      return None
+    return StoredImpactReportMetadata(
+      granularity=document['granularity'],
+      is_valid=document['isValid'],
+      updated=document['updated']
+    )
+
+  def metadata(self, rule_id: str) -> Optional[StoredImpactReportMetadata]:
+    self.ensure_indexes()
+    return self._metadata(document=self.collection.find_one({'ruleID': rule_id, 'day': metadata_day}))
+
+  def read(self, rule_id: str) -> Optional[Tuple[StoredImpactReportMetadata, pd.DataFrame]]:
+    self.ensure_indexes()
+    documents = list(self.collection.find({'ruleID': rule_id}).sort('day', ASCENDING))
+    metadata = self._metadata(document=documents[0] if documents else None)
+    if metadata is None:
+      return None
+    report = pd.DataFrame.from_records(
+      [row for d in documents[1:] for row in d['rows']],
+      columns=documents[0]['columns']
+    )
+    return metadata, report
+
+  def invalidate(self, rule_id: str):
+    self.ensure_indexes()
+    self.collection.delete_one({'ruleID': rule_id, 'day': metadata_day})
+
+  def clear(self, rule_id: str):
+    self.collection.delete_many({'ruleID': rule_id})
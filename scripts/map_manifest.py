@@ -0,0 +1,76 @@
+import json
+import pkgutil
+import importlib
+
+from pathlib import Path
+from typing import List, Optional
+
+manifest_path = Path(__file__).parent.parent / 'output' / 'state' / 'io_map_identifiers.json'
+
+manifest_packages = [
+  'io_map',
+  'io_channel',
+  'io_fetch_channel',
+  'regla',
+  'heathcliff',
+  'hazel',
+  'azrael',
+]
+
+def _import_package_modules(package_name: str) -> List[str]:
+  errors = []
+  try:
+    package = importlib.import_module(package_name)
+  except Exception as e:
+    return [f'{package_name}: {e}']
+  if not hasattr(package, '__path__'):
+    return errors
+  for module_info in pkgutil.walk_packages(package.__path__, prefix=f'{package_name}.'):
+    if '.test' in module_info.name or module_info.name.endswith('__main__'):
+      continue
+    try:
+      importlib.import_module(module_info.name)
+    except Exception as e:
+      errors.append(f'{module_info.name}: {e}')
+  return errors
+
+def generate_map_manifest(packages: List[str]=manifest_packages) -> List[str]:
+  from io_map import IOMap
+  for package_name in packages:
+    for error in _import_package_modules(package_name=package_name):
+      print(f'Skipping {error}')
+
+  identifiers = set()
+  map_classes = [IOMap]
+  while map_classes:
+    map_class = map_classes.pop()
+    map_classes.extend(map_class.__subclasses__())
+    if map_class.__module__.split('.')[0] not in packages:
+      continue
+    try:
+      identifiers.add(map_class._get_map_identifier())
+    except Exception:
+      continue
+  return sorted(identifiers)
+
+def write_map_manifest(packages: List[str]=manifest_packages, path: Path=manifest_path) -> List[str]:
+  identifiers = generate_map_manifest(packages=packages)
+  path.write_text(json.dumps(identifiers, indent=2))
+  return identifiers
+
+def load_map_manifest(path: Path=manifest_path) -> Optional[List[str]]:
+  if not path.exists():
+    return None
+  return json.loads(path.read_text())
+
+def register_map_identifiers():
+  from io_map import IOMap
+  identifiers = load_map_manifest()
+  if identifiers is None:
+    IOMap.map_auto_register = True
+    return
+  IOMap._register_map_identifiers(identifiers=identifiers)
+
+if __name__ == '__main__':
+  identifiers = write_map_manifest()
+  print(f'Wrote {len(identifiers)} IO map identifiers to {manifest_path}')
@@ -0,0 +1,112 @@
+import os
+import json
+import fcntl
+import pandas as pd
+
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
+from typing import Dict, List, Callable, Optional
+
+metrics_store_path = Path(__file__).parent.parent / 'output' / 'data' / 'metrics'
+
+class MetricsStore:
+  path: Path
+
+  def __init__(self, channel: str, credentials_fingerprint: str, entity_granularity: str, time_granularity: str, root_path: Path=metrics_store_path):
+    self.path = root_path / channel / credentials_fingerprint[:16] / entity_granularity / time_granularity
+
+  @property
+  def manifest_path(self) -> Path:
+    return self.path / 'manifest.json'
+
+  @property
+  def manifest(self) -> Dict[str, any]:
+    if not self.manifest_path.exists():
+      return {'days': {}}
+    return json.loads(self.manifest_path.read_text())
+
+  def partition_path(self, day: date) -> Path:
+    return self.path / f'day={day.isoformat()}.parquet'
+
+  @contextmanager
+  def locked(self):
+    self.path.mkdir(parents=True, exist_ok=True)
+    with open(self.path / '.lock', 'w') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def _write_manifest(self, manifest: Dict[str, any]):
+    temp_path = self.manifest_path.with_suffix('.tmp')
+    temp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(str(temp_path), str(self.manifest_path))
+
+  def _write_partition(self, day: date, report: pd.DataFrame):
+    temp_path = self.partition_path(day=day).with_suffix('.tmp')
+    report.to_parquet(str(temp_path), index=False)
+    os.replace(str(temp_path), str(self.partition_path(day=day)))
+
+  def days_to_fetch(self, start: date, end: date, settle_days: int, now: Optional[datetime]=None) -> List[date]:
+    settled_before = (now or datetime.utcnow()).date() - timedelta(days=settle_days)
+    stored_days = self.manifest['days']
+    days = []
+    day = start
+    while day <= end:
+      stored_day = stored_days.get(day.isoformat())
+      if stored_day is None or not stored_day['settled'] or day >= settled_before:
+        days.append(day)
+      day += timedelta(days=1)
+    return days
+
+  def extend(self, fetch: Callable[[datetime, datetime], pd.DataFrame], start: date, end: date, settle_days: int=2) -> List[date]:
+    with self.locked():
+      now = datetime.utcnow()
+      settled_before = now.date() - timedelta(days=settle_days)
+      days = self.days_to_fetch(
+        start=start,
+        end=end,
+        settle_days=settle_days,
+        now=now
+      )
+      for day in days:
+        day_start = datetime(day.year, day.month, day.day)
+        report = fetch(day_start, day_start)
+        self._write_partition(day=day, report=report)
+        manifest = self.manifest
+        manifest['days'][day.isoformat()] = {
+          'fetched': now.isoformat(),
+          'rows': len(report.index),
+          'settled': day < settled_before,
+        }
+        self._write_manifest(manifest=manifest)
+    return days
+
+  def fresh_until(self, start: date, end: date, max_age: float, now: Optional[datetime]=None) -> Optional[date]:
+    now = now or datetime.utcnow()
+    stored_days = self.manifest['days']
+    fresh_until = None
+    day = start
+    while day <= end:
+      stored_day = stored_days.get(day.isoformat())
+      if stored_day is None:
+        break
+      if not stored_day['settled'] and now - datetime.fromisoformat(stored_day['fetched']) > timedelta(seconds=max_age):
+        break
+      fresh_until = day
+      day += timedelta(days=1)
+    return fresh_until
+
+  def read(self, start: date, end: date) -> pd.DataFrame:
+    stored_days = self.manifest['days']
+    frames = []
+    day = start
+    while day <= end:
+      if day.isoformat() in stored_days:
+        frames.append(pd.read_parquet(str(self.partition_path(day=day))))
+      day += timedelta(days=1)
+    if not frames:
+      return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
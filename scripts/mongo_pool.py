@@ -0,0 +1,164 @@
+import time
+import threading
+
+from typing import Dict, Optional
+from pymongo import MongoClient, monitoring
+
+class PoolStatisticsListener(monitoring.ConnectionPoolListener):
+  checked_out: int
+  max_checked_out: int
+  check_outs: int
+  check_out_failures: int
+  wait_seconds: float
+  max_wait_seconds: float
+  connections_created: int
+  connections_closed: int
+  _wait_starts: threading.local
+  _lock: threading.Lock
+
+  def __init__(self):
+    self.checked_out = 0
+    self.max_checked_out = 0
+    self.check_outs = 0
+    self.check_out_failures = 0
+    self.wait_seconds = 0
+    self.max_wait_seconds = 0
+    self.connections_created = 0
+    self.connections_closed = 0
+    self._wait_starts = threading.local()
+    self._lock = threading.Lock()
+
+  def connection_check_out_started(self, event):
+    self._wait_starts.start = time.monotonic()
+
+  def _wait_time(self) -> float:
+    start = getattr(self._wait_starts, 'start', None)
+    self._wait_starts.start = None
+    return time.monotonic() - start if start is not None else 0
+
+  def connection_checked_out(self, event):
+    wait_time = self._wait_time()
+    with self._lock:
+      self.check_outs += 1
+      self.checked_out += 1
+      self.max_checked_out = max(self.max_checked_out, self.checked_out)
+      self.wait_seconds += wait_time
+      self.max_wait_seconds = max(self.max_wait_seconds, wait_time)
+
+  def connection_check_out_failed(self, event):
+    wait_time = self._wait_time()
+    with self._lock:
+      self.check_out_failures += 1
+      self.wait_seconds += wait_time
+      self.max_wait_seconds = max(self.max_wait_seconds, wait_time)
+
+  def connection_checked_in(self, event):
+    with self._lock:
+      self.checked_out = max(0, self.checked_out - 1)
+
+  def connection_created(self, event):
+    with self._lock:
+      self.connections_created += 1
+
+  def connection_closed(self, event):
+    with self._lock:
+      self.connections_closed += 1
+
+  def pool_created(self, event):
+    pass
+
+  def pool_ready(self, event):
+    pass
+
+  def pool_cleared(self, event):
+    pass
+
+  def pool_closed(self, event):
+    pass
+
+  def connection_ready(self, event):
+    pass
+
+  @property
+  def statistics(self) -> Dict[str, any]:
+    with self._lock:
+      return {
+        'checkedOut': self.checked_out,
+        'maxCheckedOut': self.max_checked_out,
+        'checkOuts': self.check_outs,
+        'checkOutFailures': self.check_out_failures,
+        'averageWaitSeconds': self.wait_seconds / self.check_outs if self.check_outs else None,
+        'maxWaitSeconds': self.max_wait_seconds,
+        'connectionsCreated': self.connections_created,
+        'connectionsClosed': self.connections_closed,
+      }
+
+class MongoClientPool:
+  max_pool_size: int
+  min_pool_size: int
+  wait_queue_timeout: Optional[float]
+  _clients: Dict[str, MongoClient]
+  _listeners: Dict[str, PoolStatisticsListener]
+  _lock: threading.Lock
+
+  def __init__(self, max_pool_size: int=10, min_pool_size: int=0, wait_queue_timeout: Optional[float]=None):
+    self.max_pool_size = max_pool_size
+    self.min_pool_size = min_pool_size
+    self.wait_queue_timeout = wait_queue_timeout
+    self._clients = {}
+    self._listeners = {}
+    self._lock = threading.Lock()
+
+  def configure(self, max_pool_size: Optional[int]=None, min_pool_size: Optional[int]=None, wait_queue_timeout: Optional[float]=None):
+    with self._lock:
+      if max_pool_size is not None:
+        self.max_pool_size = max_pool_size
+      if min_pool_size is not None:
+        self.min_pool_size = min_pool_size
+      if wait_queue_timeout is not None:
+        self.wait_queue_timeout = wait_queue_timeout
+
+  def client(self, url: str) -> MongoClient:
+    with self._lock:
+      client = self._clients.get(url)
+      if client is None:
+        listener = PoolStatisticsListener()
+        options = {
+          'maxPoolSize': self.max_pool_size,
+          'minPoolSize': self.min_pool_size,
+          'event_listeners': [listener],
+        }
+        if self.wait_queue_timeout is not None:
+          options['waitQueueTimeoutMS'] = int(self.wait_queue_timeout * 1000)
+        client = MongoClient(url, **options)
+        self._clients[url] = client
+        self._listeners[url] = listener
+      return client
+
+  def close(self, url: Optional[str]=None):
+    with self._lock:
+      urls = list(self._clients.keys()) if url is None else [url]
+      for client_url in urls:
+        client = self._clients.pop(client_url, None)
+        self._listeners.pop(client_url, None)
+        if client is not None:
+          client.close()
+
+  @property
+  def statistics(self) -> Dict[str, any]:
+    with self._lock:
+      listeners = list(enumerate(self._listeners.values()))
+      settings = {
+        'maxPoolSize': self.max_pool_size,
+        'minPoolSize': self.min_pool_size,
+        'waitQueueTimeout': self.wait_queue_timeout,
+      }
+    return {
+      **settings,
+      'clients': [
+        {'client': index, **listener.statistics}
+        for index, listener in listeners
+      ],
+    }
+
+mongo_client_pool = MongoClientPool()
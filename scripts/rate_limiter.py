@@ -0,0 +1,161 @@
+import time
+import sqlite3
+import threading
+
+from pathlib import Path
+from contextlib import closing, contextmanager
+from typing import Dict, Optional
+
+rate_limiter_path = Path(__file__).parent.parent / 'output' / 'state' / 'rate_limits.sqlite3'
+
+default_bucket = {
+  'rate': 5.0,
+  'capacity': 20.0,
+  'reserve': 0.25,
+  'borrow': 0.5,
+  'timeout': 120.0,
+  'per_call': False,
+}
+
+class RateLimit:
+  limiter: 'RateLimiter'
+  key: str
+  bucket: Dict[str, float]
+  interactive: bool
+
+  def __init__(self, limiter: 'RateLimiter', key: str, bucket: Dict[str, float], interactive: bool):
+    self.limiter = limiter
+    self.key = key
+    self.bucket = bucket
+    self.interactive = interactive
+
+  def acquire(self, tokens: float=1) -> float:
+    return self.limiter.acquire(
+      key=self.key,
+      bucket=self.bucket,
+      interactive=self.interactive,
+      tokens=tokens
+    )
+
+class RateLimiter:
+  path: Path
+  _context: threading.local
+  _initialized: bool
+
+  def __init__(self, path: Path=rate_limiter_path):
+    self.path = path
+    self._context = threading.local()
+    self._initialized = False
+
+  def connect(self) -> sqlite3.Connection:
+    connection = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+    if not self._initialized:
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('''
+        CREATE TABLE IF NOT EXISTS buckets (
+          key TEXT PRIMARY KEY,
+          tokens REAL NOT NULL,
+          updated REAL NOT NULL
+        )
+      ''')
+      connection.execute('''
+        CREATE TABLE IF NOT EXISTS statistics (
+          key TEXT NOT NULL,
+          priority TEXT NOT NULL,
+          acquired REAL NOT NULL DEFAULT 0,
+          waits INTEGER NOT NULL DEFAULT 0,
+          wait_seconds REAL NOT NULL DEFAULT 0,
+          timeouts INTEGER NOT NULL DEFAULT 0,
+          PRIMARY KEY (key, priority)
+        )
+      ''')
+      self._initialized = True
+    return connection
+
+  def _record(self, connection: sqlite3.Connection, key: str, interactive: bool, tokens: float, waited: bool, wait_seconds: float, timed_out: bool):
+    priority = 'interactive' if interactive else 'background'
+    connection.execute('INSERT OR IGNORE INTO statistics (key, priority) VALUES (?, ?)', (key, priority))
+    connection.execute(
+      'UPDATE statistics SET acquired = acquired + ?, waits = waits + ?, wait_seconds = wait_seconds + ?, timeouts = timeouts + ? WHERE key = ? AND priority = ?',
+      (tokens, 1 if waited else 0, wait_seconds if waited else 0, 1 if timed_out else 0, key, priority)
+    )
+
+  def acquire(self, key: str, bucket: Dict[str, float], interactive: bool, tokens: float=1) -> float:
+    rate = bucket['rate']
+    capacity = bucket['capacity']
+    floor = -capacity * bucket['borrow'] if interactive else capacity * bucket['reserve']
+    start = time.monotonic()
+    attempts = 0
+    while True:
+      attempts += 1
+      with closing(self.connect()) as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+          now = time.time()
+          row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+          available = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+          waited = time.monotonic() - start
+          timed_out = waited >= bucket['timeout']
+          if available - tokens >= floor or timed_out:
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, available - tokens, now))
+            self._record(connection=connection, key=key, interactive=interactive, tokens=tokens, waited=attempts > 1, wait_seconds=waited, timed_out=timed_out)
+            connection.execute('COMMIT')
+            return waited
+          connection.execute('ROLLBACK')
+        except Exception:
+          connection.execute('ROLLBACK')
+          raise
+      time.sleep(min(max(0.01, (floor + tokens - available) / rate), bucket['timeout'] - waited))
+
+  def current(self) -> Optional[RateLimit]:
+    return getattr(self._context, 'limit', None)
+
+  @contextmanager
+  def limit(self, channel: str, credentials_fingerprint: str, buckets: Dict[str, Dict[str, float]], interactive: bool):
+    bucket_options = buckets.get(channel, buckets.get('default'))
+    if bucket_options is None or bucket_options.get('disabled'):
+      yield None
+      return
+    rate_limit = RateLimit(
+      limiter=self,
+      key=f'{channel}/{credentials_fingerprint}',
+      bucket={**default_bucket, **bucket_options},
+      interactive=interactive
+    )
+    previous_limit = self.current()
+    self._context.limit = rate_limit
+    try:
+      if rate_limit.bucket['per_call']:
+        rate_limit.acquire()
+      yield rate_limit
+    finally:
+      self._context.limit = previous_limit
+
+  @property
+  def statistics(self) -> Dict[str, Dict[str, any]]:
+    with closing(self.connect()) as connection:
+      rows = connection.execute('SELECT key, priority, acquired, waits, wait_seconds, timeouts FROM statistics').fetchall()
+    statistics = {}
+    for key, priority, acquired, waits, wait_seconds, timeouts in rows:
+      statistics.setdefault(key.split('/')[0], {}).setdefault(priority, {'acquired': 0, 'waits': 0, 'waitSeconds': 0, 'timeouts': 0})
+      entry = statistics[key.split('/')[0]][priority]
+      entry['acquired'] += acquired
+      entry['waits'] += waits
+      entry['waitSeconds'] += wait_seconds
+      entry['timeouts'] += timeouts
+    return statistics
+
+rate_limiter = RateLimiter()
+
+def install_http_rate_limit():
+  from requests.adapters import HTTPAdapter
+  if getattr(HTTPAdapter.send, 'rate_limited', False):
+    return
+  send = HTTPAdapter.send
+  def rate_limited_send(adapter: HTTPAdapter, request: any, *args, **kwargs) -> any:
+    rate_limit = rate_limiter.current()
+    if rate_limit is not None:
+      rate_limit.acquire()
+    return send(adapter, request, *args, **kwargs)
+  rate_limited_send.rate_limited = True
+  HTTPAdapter.send = rate_limited_send
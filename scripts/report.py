@@ -4,6 +4,8 @@ import pandas as pd
 from io_map import IOMapKey, IOMap, IOMapGraph, IOSourceReporter, IOMultiSourceReporter
 from typing import Optional, List, Dict
 
+from .timing import span
+
 def get_metadata_report(columns: List[str], filters: Dict[str, any], options: Dict[str, any], credentials: Dict[str, any]) -> Dict[str, any]:
     IOMapGraph._register_map_identifiers([
       'heathcliff/IOAppleSearchAdsReporter',
@@ -36,7 +38,9 @@ def get_metadata_report(columns: List[str], filters: Dict[str, any], options: Di
         }
       ],
     )
-    output = graph.run(credentials=credentials)
+    with span('report_graph') as graph_span:
+      output = graph.run(credentials=credentials)
+      graph_span['rows'] = len(output['report'].index) if output.get('report') is not None else 0
     return output
 
 class StripSourceReportMetadataMap(IOMap):
@@ -63,23 +67,31 @@ class StripSourceReportMetadataMap(IOMap):
       self.report[''] = None
     self.report.reset_index(drop=True, inplace=True)
 
-    drop_indices = []
-    for index in self.report.index:
-      row = self.report.loc[index]
-      notna_columns = [c for c in row.index if pd.notna(row[c])]
-      if not notna_columns or notna_columns == ['']:
-        drop_indices.append(index)
-      row_metadata = json.loads(row['']) if '' in row and pd.notna(row['']) else []
-      for metadata_entry in row_metadata:
-        if set(metadata_entry.keys()) == {'credential', 'map'} and metadata_entry['map'] == IOMultiSourceReporter._get_map_identifier():
-          if index not in drop_indices and len(row_metadata) == 1:
-            self.report.loc[index, ''] = metadata_entry['credential']
-          continue
-        if metadata_entry not in self.metadata:
-          self.metadata.append(metadata_entry)
+    with span('strip_metadata', rows=len(self.report.index)) as strip_span:
+      notna = self.report.notna()
+      drop_mask = ~notna.drop(columns=['']).any(axis=1)
+      source_map_identifier = IOMultiSourceReporter._get_map_identifier()
+      metadata_keys = set()
+      source_credentials = {}
+      metadata_values = self.report[''][notna['']].unique()
+      for value in metadata_values:
+        row_metadata = json.loads(value)
+        for metadata_entry in row_metadata:
+          if set(metadata_entry.keys()) == {'credential', 'map'} and metadata_entry['map'] == source_map_identifier:
+            if len(row_metadata) == 1:
+              source_credentials[value] = metadata_entry['credential']
+            continue
+          metadata_key = json.dumps(metadata_entry, sort_keys=True)
+          if metadata_key not in metadata_keys:
+            metadata_keys.add(metadata_key)
+            self.metadata.append(metadata_entry)
+      if source_credentials:
+        credential_mask = ~drop_mask & self.report[''].isin(source_credentials.keys())
+        self.report.loc[credential_mask, ''] = self.report.loc[credential_mask, ''].map(source_credentials)
+      strip_span['metadataValues'] = len(metadata_values)
 
-    if drop_indices:
-      report.drop(index=drop_indices, inplace=True)
+    if drop_mask.any():
+      report.drop(index=self.report.index[drop_mask], inplace=True)
       self.report.reset_index(drop=True, inplace=True)
 
     output = self.populated_output
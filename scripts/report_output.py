@@ -0,0 +1,105 @@
+import json
+import time
+import uuid
+import pandas as pd
+
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Callable, Optional
+
+default_chunk_bytes = 4 * 1024 * 1024
+initial_chunk_rows = 1000
+
+def send_csv_chunks(report: pd.DataFrame, command_io: any, chunk_bytes: int=default_chunk_bytes) -> Dict[str, any]:
+  row_count = len(report.index)
+  chunk_rows = initial_chunk_rows
+  start_index = 0
+  chunk_index = 0
+  total_bytes = 0
+  while start_index < row_count or chunk_index == 0:
+    end_index = min(row_count, start_index + chunk_rows)
+    data = report.iloc[start_index:end_index].to_csv(index=False, header=chunk_index == 0)
+    command_io.send({
+      'chunk': {
+        'index': chunk_index,
+        'progress': end_index / row_count if row_count else 1.0,
+        'data': data,
+      },
+    })
+    total_bytes += len(data)
+    if end_index > start_index:
+      chunk_rows = max(1, int((end_index - start_index) * chunk_bytes / max(1, len(data))))
+    start_index = end_index
+    chunk_index += 1
+  return {
+    'rows': row_count,
+    'chunks': chunk_index,
+    'bytes': total_bytes,
+  }
+
+report_file_path = Path(__file__).parent.parent / 'output' / 'temp'
+report_file_prefix = 'report_'
+report_file_max_age = 60 * 60
+
+class ReportFileFormat(Enum):
+  arrow = 'arrow'
+  parquet = 'parquet'
+
+def cleanup_report_files(max_age: float=report_file_max_age, path: Path=report_file_path) -> int:
+  removed = 0
+  cutoff = time.time() - max_age
+  for file_path in path.glob(f'{report_file_prefix}*'):
+    try:
+      if file_path.stat().st_mtime < cutoff:
+        file_path.unlink()
+        removed += 1
+    except FileNotFoundError:
+      continue
+  return removed
+
+def write_report_file(report: pd.DataFrame, file_format: ReportFileFormat, path: Path=report_file_path) -> Dict[str, any]:
+  import pyarrow as pa
+  cleanup_report_files(path=path)
+  table = pa.Table.from_pandas(report, preserve_index=False)
+  file_path = path / f'{report_file_prefix}{uuid.uuid4().hex}.{file_format.value}'
+  if file_format is ReportFileFormat.arrow:
+    with pa.OSFile(str(file_path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+      writer.write_table(table)
+  else:
+    import pyarrow.parquet as pq
+    pq.write_table(table, str(file_path))
+  return {
+    'path': str(file_path),
+    'format': file_format.value,
+    'rows': table.num_rows,
+    'schema': [
+      {'name': field.name, 'type': str(field.type)}
+      for field in table.schema
+    ],
+  }
+
+def read_report_file(path: str) -> pd.DataFrame:
+  import pyarrow as pa
+  if path.endswith(f'.{ReportFileFormat.parquet.value}'):
+    import pyarrow.parquet as pq
+    return pq.read_table(path).to_pandas()
+  with pa.memory_map(path, 'r') as source:
+    return pa.ipc.open_file(source).read_all().to_pandas()
+
+def should_continue(response: Optional[str]) -> bool:
+  if response is None:
+    return False
+  try:
+    return bool(json.loads(response))
+  except json.JSONDecodeError:
+    return bool(response.strip())
+
+def send_record_pages(report: pd.DataFrame, command_io: any, page_size: int, page_message: Callable[[str, float], str]) -> bool:
+  row_count = len(report.index)
+  for start_index in range(0, max(row_count, 1), page_size):
+    end_index = min(row_count, start_index + page_size)
+    progress = end_index / row_count if row_count else 1.0
+    command_io.send_json(page_message(report.iloc[start_index:end_index].to_json(orient='records'), progress))
+    if not should_continue(command_io.receive()) and end_index < row_count:
+      return False
+  return True
@@ -1,47 +1,162 @@
 import json
-from pymongo import MongoClient
+import pandas as pd
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List, Optional
+
+from .timing import span
+from .backtest import CapturedCollection, backtest_windows, initialize_backtest_worker, run_backtest_window
+from .mongo_pool import mongo_client_pool
+from .write_buffer import BufferedCollection
+from .rule_loader import PrefetchedCollection, prefetch_rule_documents, object_id
+from .impact_store import ImpactStore, default_impact_collection, impact_granularity
 
 from regla.models.rule_model import Rule, RuleImpactReportMetadata
 
+default_collection_options = {
+  'rulesCollection': 'rules',
+  'rulesHistoryCollection': 'rulesHistory',
+  'rulesMonitorCollection': 'rulesMonitor',
+  'ruleConditionGroupsCollection': 'ruleConditionGroups',
+  'rulesImpactCollection': default_impact_collection,
+}
+
 class RuleExecutor:
+  options: Dict[str, any]
   rulesCollection: any
   conditionGroupsCollection: any
   rulesHistoryCollection: any
   rulesMonitorCollection: any
+  write_buffer: Optional[Dict[str, any]]
+  write_failures: List[Dict[str, any]]
+  impact_store: Optional[ImpactStore]
 
-  def __init__(self, options: Dict[str, any]):
-    client = MongoClient(options["databaseURL"])
-    db = client[options["database"]]
+  def __init__(self, options: Dict[str, any], write_buffer: Optional[Dict[str, any]]=None, impact_aggregates: Optional[Dict[str, any]]=None, database: Optional[any]=None):
+    self.options = options
+    db = database if database is not None else mongo_client_pool.client(url=options["databaseURL"])[options["database"]]
     self.rulesCollection = db[options["rulesCollection"]]
     self.conditionGroupsCollection = db[options["ruleConditionGroupsCollection"]]
     self.rulesHistoryCollection = db[options["rulesHistoryCollection"]]
     self.rulesMonitorCollection = db[options["rulesMonitorCollection"]]
+    self.write_buffer = write_buffer
+    self.write_failures = []
+    self.impact_store = ImpactStore(
+      collection=db[options.get("rulesImpactCollection", default_impact_collection)],
+      **impact_aggregates
+    ) if impact_aggregates is not None else None
 
   def execute(self, credentials: any, rule: Rule, granularity: str, start_date: datetime, end_date: datetime) -> Dict[str, any]:
+    if self.write_buffer is None:
+      history_collection = self.rulesHistoryCollection
+      monitor_collection = self.rulesMonitorCollection
+    else:
+      history_collection = BufferedCollection(collection=self.rulesHistoryCollection, **self.write_buffer)
+      monitor_collection = BufferedCollection(collection=self.rulesMonitorCollection, **self.write_buffer)
+    self.write_failures = []
+    try:
+      with rule.connected(
+        credentials=credentials,
+        rule_collection=self.rulesCollection,
+        history_collection=history_collection,
+        monitor_collection=monitor_collection
+      ), span('rule_execute', granularity=granularity):
+        result = rule.execute(
+          startDate=start_date,
+          endDate=end_date,
+          granularity=granularity
+        )
+    finally:
+      if self.write_buffer is not None:
+        with span('rule_writes') as writes_span:
+          history_collection.flush()
+          monitor_collection.flush()
+          self.write_failures = history_collection.failures + monitor_collection.failures
+          writes_span['batches'] = history_collection.flushes + monitor_collection.flushes
+  
+    return result
+  
+  def dry_run(self, credentials: any, rule: Rule, granularity: str, start_date: datetime, end_date: datetime) -> List[Dict[str, any]]:
+    rule_collection = CapturedCollection(collection=self.rulesCollection)
+    history_collection = CapturedCollection(collection=self.rulesHistoryCollection)
+    monitor_collection = CapturedCollection(collection=self.rulesMonitorCollection)
+    rule.dryRun = True
     with rule.connected(
       credentials=credentials,
-      rule_collection=self.rulesCollection,
-      history_collection=self.rulesHistoryCollection,
-      monitor_collection=self.rulesMonitorCollection
-    ):
-      result = rule.execute(
+      rule_collection=rule_collection,
+      history_collection=history_collection,
+      monitor_collection=monitor_collection
+    ), span('rule_dry_run', granularity=granularity):
+      rule.execute(
         startDate=start_date,
         endDate=end_date,
         granularity=granularity
       )
-  
-    return result
-  
-  def get_rule(self, rule_id: str) -> Dict[str, any]:
-    return Rule.ruleWithID(
-      rulesCollection=self.rulesCollection,
-      conditionGroupsCollection=self.conditionGroupsCollection,
-      id=rule_id
+    return [d for d in history_collection.documents if d.get('historyType') == 'action']
+
+  def backtest(self, credentials: any, rule_id: str, granularity: str, start_date: datetime, end_date: datetime, window_days: int=1, step_days: Optional[int]=None, processes: Optional[int]=None, rate_limit: Optional[Dict[str, any]]=None, database_configuration: Optional[Dict[str, any]]=None) -> pd.DataFrame:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    windows = backtest_windows(
+      start_date=start_date,
+      end_date=end_date,
+      window_days=window_days,
+      step_days=step_days
     )
+    with span('rule_backtest', windows=len(windows)) as backtest_span:
+      rule_documents, condition_groups = prefetch_rule_documents(
+        rules_collection=self.rulesCollection,
+        condition_groups_collection=self.conditionGroupsCollection,
+        rule_ids=[rule_id]
+      )
+      if not rule_documents:
+        raise ValueError(f'Rule {rule_id} not found')
+      with ProcessPoolExecutor(
+        max_workers=min(len(windows), processes or multiprocessing.cpu_count()) or 1,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=initialize_backtest_worker,
+        initargs=(self.options, rule_id, rule_documents, condition_groups, credentials, granularity, rate_limit, database_configuration, (windows[0][0], windows[-1][1]) if windows else None)
+      ) as executor:
+        actions = [a for window_actions in executor.map(run_backtest_window, windows) for a in window_actions]
+      backtest_span['actions'] = len(actions)
+    return pd.DataFrame.from_records(actions, columns=None if actions else ['windowStart', 'windowEnd'])
+
+  def get_rule(self, rule_id: str) -> Dict[str, any]:
+    with span('rule_load'):
+      return Rule.ruleWithID(
+        rulesCollection=self.rulesCollection,
+        conditionGroupsCollection=self.conditionGroupsCollection,
+        id=rule_id
+      )
   
-  def get_impact_report_metadata(self, credentials: any, rule: Rule) -> RuleImpactReportMetadata:
+  def get_rules(self, rule_ids: List[str]) -> Dict[str, Rule]:
+    with span('rule_load', rules=len(rule_ids)) as load_span:
+      rules, condition_groups = prefetch_rule_documents(
+        rules_collection=self.rulesCollection,
+        condition_groups_collection=self.conditionGroupsCollection,
+        rule_ids=rule_ids
+      )
+      rules_collection = PrefetchedCollection(collection=self.rulesCollection, documents=rules)
+      condition_groups_collection = PrefetchedCollection(collection=self.conditionGroupsCollection, documents=condition_groups)
+      loaded_rules = {
+        rule_id: Rule.ruleWithID(
+          rulesCollection=rules_collection,
+          conditionGroupsCollection=condition_groups_collection,
+          id=rule_id
+        )
+        for rule_id in rule_ids
+        if rule_id in rules_collection.documents
+      }
+      load_span['conditionGroups'] = len(condition_groups)
+      load_span['fallbackQueries'] = rules_collection.misses + condition_groups_collection.misses
+    return loaded_rules
+
+  def get_rule_channels(self, rule_ids: List[str]) -> Dict[str, str]:
+    return {
+      str(d['_id']): d['channel']
+      for d in self.rulesCollection.find({'_id': {'$in': [object_id(i) for i in rule_ids]}}, {'channel': 1})
+      if d.get('channel') is not None
+    }
+
+  def _compute_impact_report_metadata(self, credentials: any, rule: Rule) -> RuleImpactReportMetadata:
     with rule.connected(
       credentials=credentials,
       history_collection=self.rulesHistoryCollection,
@@ -49,15 +164,55 @@ class RuleExecutor:
     ):
       metadata = rule.impactReportMetadata()
     return metadata
-  
-  def get_impact_report(self, credentials: any, rule: Rule) -> Dict[str, any]:
+
+  def _compute_impact_report(self, credentials: any, rule: Rule) -> pd.DataFrame:
     with rule.connected(
       credentials=credentials,
       history_collection=self.rulesHistoryCollection,
       monitor_collection=self.rulesMonitorCollection,
-    ):
+    ), span('impact_report') as report_span:
       report = rule.getImpactReport()
+      report_span['rows'] = len(report.index)
     if 'installs' in report.columns and 'conversions' not in report.columns:
       report.rename(columns={'installs': 'conversions'}, inplace=True)
 
-    return report
\ No newline at end of file
+    return report
+
+  def get_impact_report_metadata(self, credentials: any, rule: Rule, rule_id: Optional[str]=None) -> RuleImpactReportMetadata:
+    if rule_id is not None and self.impact_store is not None:
+      with span('impact_metadata_read'):
+        metadata = self.impact_store.metadata(rule_id=rule_id)
+      if metadata is not None:
+        return metadata
+    return self._compute_impact_report_metadata(credentials=credentials, rule=rule)
+  
+  def get_impact_report(self, credentials: any, rule: Rule, rule_id: Optional[str]=None, metadata: Optional[RuleImpactReportMetadata]=None) -> pd.DataFrame:
+    if rule_id is not None and self.impact_store is not None:
+      with span('impact_report_read') as read_span:
+        stored = self.impact_store.read(rule_id=rule_id)
+        read_span['rows'] = len(stored[1].index) if stored is not None else None
+      if stored is not None:
+        return stored[1]
+    report = self._compute_impact_report(credentials=credentials, rule=rule)
+    if rule_id is not None and self.impact_store is not None and metadata is not None:
+      self.impact_store.write(
+        rule_id=rule_id,
+        granularity=impact_granularity(metadata=metadata),
+        is_valid=metadata.is_valid,
+        report=report
+      )
+    return report
+
+  def refresh_impact_aggregate(self, credentials: any, rule: Rule, rule_id: str, since: Optional[datetime]=None) -> Dict[str, int]:
+    with span('impact_refresh') as refresh_span:
+      metadata = self._compute_impact_report_metadata(credentials=credentials, rule=rule)
+      report = self._compute_impact_report(credentials=credentials, rule=rule) if metadata.is_valid else None
+      result = self.impact_store.write(
+        rule_id=rule_id,
+        granularity=impact_granularity(metadata=metadata),
+        is_valid=metadata.is_valid,
+        report=report,
+        since=since.strftime('%Y-%m-%d') if since is not None else None
+      )
+      refresh_span.update(result)
+    return result
@@ -0,0 +1,90 @@
+from bson import ObjectId
+from typing import Dict, List, Tuple, Iterable, Optional
+
+rule_projection = {
+  'created': 0,
+  'modified': 0,
+  '__v': 0,
+}
+
+condition_group_projection = {
+  'conditions': 1,
+  'subgroups': 1,
+  'operator': 1,
+}
+
+def object_id(value: any) -> any:
+  if isinstance(value, str) and ObjectId.is_valid(value):
+    return ObjectId(value)
+  return value
+
+class PrefetchedCollection:
+  collection: any
+  documents: Dict[str, Dict[str, any]]
+  misses: int
+
+  def __init__(self, collection: any, documents: Iterable[Dict[str, any]]):
+    self.collection = collection
+    self.documents = {str(d['_id']): d for d in documents}
+    self.misses = 0
+
+  def _prefetched(self, filter: Optional[Dict[str, any]]) -> Optional[List[Dict[str, any]]]:
+    if not filter or set(filter.keys()) != {'_id'}:
+      return None
+    value = filter['_id']
+    if isinstance(value, dict):
+      if set(value.keys()) != {'$in'}:
+        return None
+      ids = [str(v) for v in value['$in']]
+    else:
+      ids = [str(value)]
+    if any(i not in self.documents for i in ids):
+      return None
+    return [self.documents[i] for i in ids]
+
+  def find_one(self, filter: Optional[Dict[str, any]]=None, *args, **kwargs) -> Optional[Dict[str, any]]:
+    if not args and not kwargs:
+      documents = self._prefetched(filter=filter)
+      if documents is not None:
+        return dict(documents[0]) if documents else None
+    self.misses += 1
+    return self.collection.find_one(filter, *args, **kwargs)
+
+  def find(self, filter: Optional[Dict[str, any]]=None, *args, **kwargs) -> any:
+    if not args and not kwargs:
+      documents = self._prefetched(filter=filter)
+      if documents is not None:
+        return iter([dict(d) for d in documents])
+    self.misses += 1
+    return self.collection.find(filter, *args, **kwargs)
+
+  def __getattr__(self, name: str) -> any:
+    return getattr(self.collection, name)
+
+def prefetch_rule_documents(rules_collection: any, condition_groups_collection: any, rule_ids: List[str]) -> Tuple[List[Dict[str, any]], List[Dict[str, any]]]:
+  rules = list(rules_collection.find(
+    {'_id': {'$in': [object_id(i) for i in rule_ids]}},
+    rule_projection
+  ))
+  group_ids = {
+    task['conditionGroup']
+    for rule in rules
+    for task in rule.get('tasks', [])
+    if task.get('conditionGroup') is not None
+  }
+  condition_groups = []
+  fetched_group_ids = set()
+  while group_ids:
+    fetched_group_ids.update(str(i) for i in group_ids)
+    groups = list(condition_groups_collection.find(
+      {'_id': {'$in': [object_id(i) for i in group_ids]}},
+      condition_group_projection
+    ))
+    condition_groups.extend(groups)
+    group_ids = {
+      subgroup
+      for group in groups
+      for subgroup in group.get('subgroups', [])
+      if str(subgroup) not in fetched_group_ids
+    }
+  return rules, condition_groups
@@ -0,0 +1,425 @@
+import os
+import json
+import uuid
+import heapq
+import socket
+import threading
+import traceback
+
+from bson import ObjectId
+from moda import log
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import PyMongoError, OperationFailure
+from typing import Dict, List, Tuple, Callable, Optional
+
+default_run_interval = 60 * 60 * 1000
+default_max_run_time = 10 * 60
+scheduler_collection_name = 'ruleSchedulers'
+epoch = datetime(1970, 1, 1)
+schedule_index_name = 'isEnabled_1_nextRunAt_1'
+schedule_fields = {'lastRun', 'runInterval', 'isEnabled'}
+notification_fields = ['shouldSendEmail', 'shouldMonitor']
+unnotified_query = {f: {'$ne': True} for f in notification_fields}
+
+next_run_at_expression = {
+  '$add': [
+    {'$ifNull': ['$lastRun', epoch]},
+    {'$ifNull': ['$runInterval', default_run_interval]},
+  ],
+}
+
+def ensure_schedule(rules_collection: any) -> int:
+  rules_collection.create_index([('isEnabled', ASCENDING), ('nextRunAt', ASCENDING)], name=schedule_index_name)
+  result = rules_collection.update_many(
+    {'nextRunAt': {'$exists': False}},
+    [{'$set': {'nextRunAt': next_run_at_expression}}]
+  )
+  return result.modified_count
+
+def worker_id() -> str:
+  return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+def record_failed_run(history_collection: any, rule_document: Dict[str, any], errors: List[str]):
+  description = rule_document.get('metadata', {}).get('description')
+  history_collection.insert_one({
+    'historyCreationDate': datetime.utcnow(),
+    'historyType': 'failed',
+    'targetID': -1,
+    'actionDescription': f'<strong>FAIL: </strong>Did not complete execution for rule {description}',
+    'errorDescriptions': errors,
+    'userID': rule_document['user'],
+    'ruleID': rule_document['_id'],
+    'channel': rule_document.get('channel'),
+    'ruleDescription': description,
+  })
+
+class RuleScheduler:
+  rules_collection: any
+  run_rule: Callable[[Dict[str, any]], None]
+  on_timeout: Optional[Callable[[Dict[str, any]], None]]
+  owner: str
+  lease_duration: timedelta
+  max_run_time: timedelta
+  horizon: timedelta
+  max_concurrent: int
+  poll_interval: float
+  resync_interval: float
+  runs: int
+  failures: int
+  lost_leases: int
+  timeouts: int
+  _queue: List[Tuple[datetime, str]]
+  _scheduled: Dict[str, datetime]
+  _running: Dict[str, any]
+  _started: Dict[str, Tuple[datetime, Dict[str, any]]]
+  _timed_out: set
+  _loaded_until: datetime
+  _last_resync: Optional[datetime]
+  _watching: bool
+  _stop: threading.Event
+  _wake: threading.Event
+  _lock: threading.Lock
+
+  def __init__(self, rules_collection: any, run_rule: Callable[[Dict[str, any]], None], owner: Optional[str]=None, lease_duration: float=5 * 60, horizon: float=60, max_concurrent: int=5, poll_interval: float=10, resync_interval: float=60, max_run_time: float=default_max_run_time, on_timeout: Optional[Callable[[Dict[str, any]], None]]=None):
+    self.rules_collection = rules_collection
+    self.run_rule = run_rule
+    self.on_timeout = on_timeout
+    self.owner = owner if owner is not None else worker_id()
+    self.lease_duration = timedelta(seconds=lease_duration)
+    self.max_run_time = timedelta(seconds=max_run_time)
+    self.horizon = timedelta(seconds=horizon)
+    self.max_concurrent = max_concurrent
+    self.poll_interval = poll_interval
+    self.resync_interval = resync_interval
+    self.runs = 0
+    self.failures = 0
+    self.lost_leases = 0
+    self.timeouts = 0
+    self._queue = []
+    self._scheduled = {}
+    self._running = {}
+    self._started = {}
+    self._timed_out = set()
+    self._loaded_until = epoch
+    self._last_resync = None
+    self._watching = False
+    self._stop = threading.Event()
+    self._wake = threading.Event()
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def due_at(document: Dict[str, any]) -> Optional[datetime]:
+    if not document.get('isEnabled') or document.get('nextRunAt') is None or any(document.get(f) for f in notification_fields):
+      return None
+    lease = document.get('lease')
+    if lease is not None and lease['expiresAt'] > document['nextRunAt']:
+      return lease['expiresAt']
+    return document['nextRunAt']
+
+  def _schedule(self, rule_id: str, due_at: Optional[datetime]):
+    with self._lock:
+      if due_at is None or due_at > self._loaded_until:
+        self._scheduled.pop(rule_id, None)
+        return
+      if self._scheduled.get(rule_id) == due_at:
+        return
+      self._scheduled[rule_id] = due_at
+      heapq.heappush(self._queue, (due_at, rule_id))
+    self._wake.set()
+
+  def load_due(self, now: datetime):
+    loaded_until = now + self.horizon
+    with self._lock:
+      self._loaded_until = loaded_until
+    documents = self.rules_collection.find(
+      {'isEnabled': True, 'nextRunAt': {'$lte': loaded_until}, **unnotified_query},
+      {'isEnabled': 1, 'nextRunAt': 1, 'lease': 1}
+    ).sort('nextRunAt', ASCENDING).hint(schedule_index_name)
+    for document in documents:
+      self._schedule(rule_id=str(document['_id']), due_at=self.due_at(document=document))
+
+  def apply_change(self, change: Dict[str, any]):
+    rule_id = str(change['documentKey']['_id'])
+    if change['operationType'] == 'delete':
+      self._schedule(rule_id=rule_id, due_at=None)
+      return
+    update_description = change.get('updateDescription', {})
+    changed_fields = set(update_description.get('updatedFields', {}).keys()) | set(update_description.get('removedFields', []))
+    lease_changed = any(f.split('.')[0] == 'lease' for f in changed_fields)
+    if change['operationType'] in ['insert', 'replace'] or (changed_fields & schedule_fields and 'nextRunAt' not in changed_fields and not lease_changed):
+      document = self.rules_collection.find_one_and_update(
+        {'_id': change['documentKey']['_id'], 'lease': None},
+        [{'$set': {'nextRunAt': next_run_at_expression}}],
+        projection={'isEnabled': 1, 'nextRunAt': 1, 'lease': 1, **{f: 1 for f in notification_fields}},
+        return_document=ReturnDocument.AFTER
+      )
+      if document is None:
+        document = change.get('fullDocument')
+    else:
+      document = change.get('fullDocument')
+    self._schedule(rule_id=rule_id, due_at=self.due_at(document=document) if document is not None else None)
+
+  def watch(self):
+    try:
+      with self.rules_collection.watch(
+        [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}],
+        full_document='updateLookup'
+      ) as stream:
+        self._watching = True
+        for change in stream:
+          self.apply_change(change=change)
+          if self._stop.is_set():
+            break
+    except OperationFailure as e:
+      log.log(f'Rule change stream unavailable, resyncing rule schedules every {self.resync_interval} seconds instead: {e}')
+    except PyMongoError:
+      log.log(f'Rule change stream stopped, resyncing rule schedules every {self.resync_interval} seconds instead:\n{traceback.format_exc()}')
+    finally:
+      self._watching = False
+
+  def resync(self):
+    ensure_schedule(rules_collection=self.rules_collection)
+    self.rules_collection.update_many(
+      {'lease': None, '$expr': {'$ne': ['$nextRunAt', next_run_at_expression]}},
+      [{'$set': {'nextRunAt': next_run_at_expression}}]
+    )
+
+  def claim(self, rule_id: str, now: datetime) -> Optional[Dict[str, any]]:
+    return self.rules_collection.find_one_and_update(
+      {
+        '_id': ObjectId(rule_id),
+        'isEnabled': True,
+        'nextRunAt': {'$lte': now},
+        **unnotified_query,
+        '$or': [
+          {'lease': None},
+          {'lease.expiresAt': {'$lte': now}},
+        ],
+      },
+      {'$set': {
+        'lastRun': now,
+        'lease': {
+          'owner': self.owner,
+          'claimedAt': now,
+          'expiresAt': now + self.lease_duration,
+        },
+      }},
+      return_document=ReturnDocument.AFTER
+    )
+
+  def renew_leases(self) -> int:
+    with self._lock:
+      rule_ids = [ObjectId(i) for i in self._running if i not in self._timed_out]
+    if not rule_ids:
+      return 0
+    result = self.rules_collection.update_many(
+      {'_id': {'$in': rule_ids}, 'lease.owner': self.owner},
+      {'$set': {'lease.expiresAt': datetime.utcnow() + self.lease_duration}}
+    )
+    return result.modified_count
+
+  def release(self, rule_id: str) -> bool:
+    result = self.rules_collection.update_one(
+      {'_id': ObjectId(rule_id), 'lease.owner': self.owner},
+      [
+        {'$set': {'nextRunAt': {'$add': ['$lastRun', {'$ifNull': ['$runInterval', default_run_interval]}]}}},
+        {'$unset': 'lease'},
+      ]
+    )
+    return result.modified_count == 1
+
+  def expire_runs(self, now: datetime) -> List[str]:
+    with self._lock:
+      timed_out = [
+        rule_id
+        for rule_id, (started_at, _) in self._started.items()
+        if rule_id not in self._timed_out and now - started_at >= self.max_run_time
+      ]
+      self._timed_out.update(timed_out)
+      self.timeouts += len(timed_out)
+      rules = [self._started[rule_id][1] for rule_id in timed_out]
+    for rule_id, rule in zip(timed_out, rules):
+      log.log(f'Scheduled run of rule {rule_id} timed out after {self.max_run_time}, no longer renewing its lease')
+      if self.on_timeout is None:
+        continue
+      try:
+        self.on_timeout(rule)
+      except Exception:
+        log.log(f'Failed to record the timed out run of rule {rule_id}:\n{traceback.format_exc()}')
+    return timed_out
+
+  def register(self):
+    now = datetime.utcnow()
+    self.rules_collection.database[scheduler_collection_name].update_one(
+      {'_id': self.owner},
+      {'$set': {'heartbeatAt': now, 'expiresAt': now + self.lease_duration}},
+      upsert=True
+    )
+
+  def unregister(self):
+    self.rules_collection.database[scheduler_collection_name].delete_one({'_id': self.owner})
+
+  def heartbeat(self):
+    interval = self.lease_duration.total_seconds() / 3
+    while not self._stop.wait(timeout=interval):
+      self.expire_runs(now=datetime.utcnow())
+      try:
+        self.register()
+        self.renew_leases()
+      except PyMongoError:
+        log.log(f'Failed to renew rule leases for {self.owner}:\n{traceback.format_exc()}')
+
+  def _pop_due(self, now: datetime) -> Optional[str]:
+    with self._lock:
+      while self._queue and self._queue[0][0] <= now:
+        due_at, rule_id = heapq.heappop(self._queue)
+        if self._scheduled.get(rule_id) != due_at or rule_id in self._running:
+          continue
+        del self._scheduled[rule_id]
+        return rule_id
+    return None
+
+  def _next_wake(self, now: datetime) -> float:
+    with self._lock:
+      next_due = self._queue[0][0] if self._queue else self._loaded_until
+    return max(0.05, min(self.poll_interval, (min(next_due, self._loaded_until) - now).total_seconds()))
+
+  def _finish(self, rule_id: str, future: any):
+    exception = future.exception()
+    if exception is not None:
+      log.log(f'Scheduled run of rule {rule_id} failed:\n{"".join(traceback.format_exception(type(exception), exception, exception.__traceback__))}')
+    try:
+      released = self.release(rule_id=rule_id)
+    except PyMongoError:
+      released = False
+      log.log(f'Failed to release the lease on rule {rule_id}:\n{traceback.format_exc()}')
+    with self._lock:
+      self._running.pop(rule_id, None)
+      self._started.pop(rule_id, None)
+      self.runs += 1
+      if exception is not None or rule_id in self._timed_out:
+        self.failures += 1
+      self._timed_out.discard(rule_id)
+      if not released:
+        self.lost_leases += 1
+    self._wake.set()
+
+  def run(self, max_runs: Optional[int]=None):
+    ensure_schedule(rules_collection=self.rules_collection)
+    self.rules_collection.database[scheduler_collection_name].create_index('expiresAt', expireAfterSeconds=0)
+    self.register()
+    threading.Thread(target=self.watch, daemon=True).start()
+    threading.Thread(target=self.heartbeat, daemon=True).start()
+    try:
+      self._run(max_runs=max_runs)
+    finally:
+      self._stop.set()
+      try:
+        self.unregister()
+      except PyMongoError:
+        log.log(f'Failed to unregister rule scheduler {self.owner}:\n{traceback.format_exc()}')
+
+  def _run(self, max_runs: Optional[int]):
+    with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+      while not self._stop.is_set() and (max_runs is None or self.runs + len(self._running) < max_runs):
+        now = datetime.utcnow()
+        if not self._watching and (self._last_resync is None or (now - self._last_resync).total_seconds() >= self.resync_interval):
+          self.resync()
+          self._last_resync = now
+        if now + self.horizon / 2 >= self._loaded_until:
+          self.load_due(now=now)
+        while len(self._running) < self.max_concurrent:
+          rule_id = self._pop_due(now=now)
+          if rule_id is None:
+            break
+          rule = self.claim(rule_id=rule_id, now=now)
+          if rule is None:
+            continue
+          with self._lock:
+            future = executor.submit(self.run_rule, rule)
+            self._running[rule_id] = future
+            self._started[rule_id] = (now, rule)
+          future.add_done_callback(lambda future, rule_id=rule_id: self._finish(rule_id=rule_id, future=future))
+        self._wake.wait(timeout=self._next_wake(now=now))
+        self._wake.clear()
+
+  def stop(self):
+    self._stop.set()
+    self._wake.set()
+
+  @property
+  def statistics(self) -> Dict[str, any]:
+    with self._lock:
+      return {
+        'owner': self.owner,
+        'queued': len(self._scheduled),
+        'running': len(self._running),
+        'runs': self.runs,
+        'failures': self.failures,
+        'lostLeases': self.lost_leases,
+        'timeouts': self.timeouts,
+        'watching': self._watching,
+      }
+
+def scheduled_rule_runner(db: any, create_rule_executor: Callable[[], any], configure: Dict[str, any]) -> Callable[[Dict[str, any]], None]:
+  from regla import RuleSerializer
+  from .api import prepare_credentials, apply_dry_run_configuration, channel_rate_limit, update_impact_aggregate
+  from .accounts import account_credentials
+  executors = threading.local()
+  def run_rule(rule_document: Dict[str, any]):
+    if any(rule_document.get(f) for f in notification_fields):
+      raise ValueError(f'Rule {rule_document["_id"]} sends notifications, which only the Node rule runner delivers')
+    if getattr(executors, 'rule_executor', None) is None:
+      executors.rule_executor = create_rule_executor()
+    rule_executor = executors.rule_executor
+    rule_id = str(rule_document['_id'])
+    credentials = account_credentials(db=db, account=rule_document['account'])
+    if credentials is None:
+      raise ValueError(f'No credentials for account {rule_document["account"]}')
+    rate_limit_args = {'credentials': credentials, 'channel': rule_document['channel'], 'priority': 'background'}
+    credentials = prepare_credentials({'credentials': credentials})
+    rule = rule_executor.get_rule(rule_id=rule_id)
+    apply_dry_run_configuration(
+      rule=rule,
+      args={},
+      configure=configure
+    )
+    end_date = datetime.now()
+    start_date = end_date - timedelta(milliseconds=rule_document['dataCheckRange'])
+    log.log(f'Executing scheduled rule {rule_id}')
+    try:
+      with channel_rate_limit(rate_limit_args, configure):
+        result = rule_executor.execute(
+          credentials=credentials,
+          rule=rule,
+          granularity='HOURLY',
+          start_date=datetime(start_date.year, start_date.month, start_date.day),
+          end_date=datetime(end_date.year, end_date.month, end_date.day)
+        )
+    except Exception:
+      record_failed_run(
+        history_collection=rule_executor.rulesHistoryCollection,
+        rule_document=rule_document,
+        errors=[traceback.format_exc()]
+      )
+      raise
+    serialized_result = json.loads(json.dumps(result, cls=RuleSerializer))
+    if isinstance(serialized_result, dict) and serialized_result.get('report'):
+      rule_executor.rulesCollection.update_one({'_id': rule_document['_id']}, {'$set': {'lastTriggered': datetime.utcnow()}})
+    if rule_executor.write_failures:
+      log.log(f'Scheduled rule {rule_id} failed to write {sum(f["failed"] for f in rule_executor.write_failures)} history or monitor documents')
+    try:
+      with channel_rate_limit(rate_limit_args, configure):
+        update_impact_aggregate(
+          rule_executor=rule_executor,
+          credentials=credentials,
+          rule=rule,
+          rule_id=rule_id,
+          since=datetime(start_date.year, start_date.month, start_date.day),
+          configure=configure
+        )
+    except Exception:
+      log.log(f'Failed to update impact aggregate for scheduled rule {rule_id}:\n{traceback.format_exc()}')
+  return run_rule
@@ -1,5 +1,8 @@
+import io
 import os
 import re
+import sys
+import time
 import click
 import json
 import shutil
@@ -7,6 +10,8 @@ import urllib
 import string
 import secrets
 import tempfile
+import traceback
+import subprocess
 import fabrica
 
 from pathlib import Path
@@ -472,6 +477,552 @@ def migrate(data_dragon: DataDragon, data_context: DataContext, from_version: st
   layer.commit()
   layer.disconnect()
 
+@data.command(name='rebuild-impact')
+@click.option('-r', '--rule-id', 'rule_ids', multiple=True)
+@click.option('-d/-D', '--include-disabled/--exclude-disabled', 'include_disabled', is_flag=True)
+@click.pass_obj
+@pass_data_dragon
+def rebuild_impact(data_dragon: DataDragon, data_context: DataContext, rule_ids: Tuple[str], include_disabled: bool):
+  from bson import ObjectId
+  from scripts.api import prepare_credentials, impact_aggregate_options, impact_collection_options
+  from scripts.accounts import account_credentials
+  from scripts.map_manifest import register_map_identifiers
+  from scripts.rule_executor import RuleExecutor, default_collection_options
+  impact_aggregates = impact_aggregate_options(configure=data_dragon.configuration)
+  if impact_aggregates is None:
+    raise click.ClickException('Set impact_aggregates.enabled in configure.json before rebuilding impact aggregates')
+  register_map_identifiers()
+  layer = SQL.Layer()
+  layer.connect()
+  db = layer.get_database()
+  rule_executor = RuleExecutor(
+    options=impact_collection_options(options=default_collection_options, configure=data_dragon.configuration),
+    impact_aggregates=impact_aggregates,
+    database=db
+  )
+
+  query = {} if include_disabled else {'isEnabled': True}
+  if rule_ids:
+    query['_id'] = {'$in': [ObjectId(i) for i in rule_ids]}
+  rule_documents = list(db.rules.find(query, {'account': 1}))
+  rules = rule_executor.get_rules(rule_ids=[str(d['_id']) for d in rule_documents])
+  failed = 0
+  for index, rule_document in enumerate(rule_documents):
+    rule_id = str(rule_document['_id'])
+    try:
+      credentials = account_credentials(db=db, account=rule_document['account'])
+      if credentials is None:
+        raise ValueError(f'No credentials for account {rule_document["account"]}')
+      result = rule_executor.refresh_impact_aggregate(
+        credentials=prepare_credentials({'credentials': credentials}),
+        rule=rules[rule_id],
+        rule_id=rule_id
+      )
+      log.log(f'{index + 1}/{len(rule_documents)} rule {rule_id}: {result["days"]} days, {result["changedDays"]} changed, {result["removedDays"]} removed')
+    except Exception as e:
+      failed += 1
+      log.log(f'{index + 1}/{len(rule_documents)} rule {rule_id}: failed to rebuild impact aggregate: {e}')
+  layer.disconnect()
+  if failed:
+    raise click.ClickException(f'Failed to rebuild impact aggregates for {failed} of {len(rule_documents)} rules')
+
+@run.group(name='rules')
+@click.pass_obj
+@click.pass_context
+@invoke_subcommand()
+def rules(ctx: any, data_dragon: DataDragon):
+  SQL.Layer.configure_connection(data_dragon.environment['databases']['default'])
+
+@rules.command(name='schedule')
+@click.option('-c', '--concurrency', 'max_concurrent', type=int, default=5)
+@click.option('-h', '--horizon', 'horizon', type=float, default=60)
+@click.option('-p', '--poll-interval', 'poll_interval', type=float, default=10)
+@click.option('-l', '--lease-duration', 'lease_duration', type=float, default=5 * 60)
+@click.option('-t', '--max-run-time', 'max_run_time', type=float, default=10 * 60)
+@click.option('-n', '--max-runs', 'max_runs', type=int)
+@pass_data_dragon
+def rules_schedule(data_dragon: DataDragon, max_concurrent: int, horizon: float, poll_interval: float, lease_duration: float, max_run_time: float, max_runs: Optional[int]):
+  from scripts.api import enabled_options, impact_aggregate_options, impact_collection_options
+  from scripts.map_manifest import register_map_identifiers
+  from scripts.rule_executor import RuleExecutor, default_collection_options
+  from scripts.rule_scheduler import RuleScheduler, scheduled_rule_runner, record_failed_run
+  if not data_dragon.configuration.get('rule_scheduler'):
+    raise click.ClickException('Set rule_scheduler in configure.json so the Node rule cron leaves rules without notifications to this scheduler')
+  if data_dragon.configuration.get('disable_rule_cron'):
+    log.log('Warning: disable_rule_cron is set, so rules that send email or monitor will not run')
+  register_map_identifiers()
+  layer = SQL.Layer()
+  layer.connect()
+  db = layer.get_database()
+  configuration = data_dragon.configuration
+  history_collection = db[default_collection_options['rulesHistoryCollection']]
+  scheduler = RuleScheduler(
+    rules_collection=db[default_collection_options['rulesCollection']],
+    run_rule=scheduled_rule_runner(
+      db=db,
+      create_rule_executor=lambda: RuleExecutor(
+        options=impact_collection_options(options=default_collection_options, configure=configuration),
+        write_buffer=enabled_options(configuration.get('rule_write_buffer', {})),
+        impact_aggregates=impact_aggregate_options(configure=configuration),
+        database=db
+      ),
+      configure=configuration
+    ),
+    lease_duration=lease_duration,
+    horizon=horizon,
+    max_concurrent=max_concurrent,
+    poll_interval=poll_interval,
+    max_run_time=max_run_time,
+    on_timeout=lambda rule: record_failed_run(
+      history_collection=history_collection,
+      rule_document=rule,
+      errors=[f'Rule run timed out after {max_run_time} seconds']
+    )
+  )
+  try:
+    scheduler.run(max_runs=max_runs)
+  except KeyboardInterrupt:
+    scheduler.stop()
+  finally:
+    log.log(f'Rule scheduler statistics: {json.dumps(scheduler.statistics)}')
+    layer.disconnect()
+
+def rule_lease_worker(database_url: str, database: str, run_seconds: float, max_concurrent: int, deadline: float):
+  import threading
+  from pymongo import MongoClient
+  from scripts.rule_scheduler import RuleScheduler, ensure_schedule
+  client = MongoClient(database_url)
+  db = client[database]
+
+  def run_rule(rule: Dict[str, any]):
+    start = datetime.utcnow()
+    time.sleep(run_seconds)
+    db.claims.insert_one({'ruleID': rule['_id'], 'owner': scheduler.owner, 'start': start, 'end': datetime.utcnow()})
+
+  scheduler = RuleScheduler(
+    rules_collection=db.rules,
+    run_rule=run_rule,
+    lease_duration=max(1, run_seconds * 3),
+    horizon=5,
+    max_concurrent=max_concurrent,
+    poll_interval=0.2,
+    resync_interval=5
+  )
+
+  def stop_when_idle():
+    while time.time() < deadline and db.rules.count_documents({'nextRunAt': {'$lte': datetime.utcnow()}}):
+      time.sleep(0.2)
+    scheduler.stop()
+
+  ensure_schedule(rules_collection=db.rules)
+  threading.Thread(target=stop_when_idle, daemon=True).start()
+  scheduler.run()
+  client.close()
+
+@rules.command(name='verify-leases')
+@click.option('-u', '--database-url', 'database_url', default='mongodb://localhost:27017')
+@click.option('-d', '--database', 'database', default='datadragon_lease_verification')
+@click.option('-r', '--rules', 'rule_count', type=int, default=200)
+@click.option('-w', '--workers', 'worker_counts', type=int, multiple=True, default=[1, 2, 4])
+@click.option('-c', '--concurrency', 'max_concurrent', type=int, default=5)
+@click.option('-s', '--run-seconds', 'run_seconds', type=float, default=0.2)
+@click.option('-t', '--timeout', 'timeout', type=float, default=300)
+@pass_data_dragon
+def rules_verify_leases(data_dragon: DataDragon, database_url: str, database: str, rule_count: int, worker_counts: Tuple[int], max_concurrent: int, run_seconds: float, timeout: float):
+  import multiprocessing
+  from pymongo import MongoClient
+  from scripts.rule_scheduler import ensure_schedule
+  client = MongoClient(database_url)
+  if database in client.list_database_names():
+    raise click.ClickException(f'Refusing to verify leases in existing database {database}')
+  db = client[database]
+  failed = False
+  try:
+    for worker_count in worker_counts:
+      client.drop_database(database)
+      now = datetime.utcnow()
+      db.rules.insert_many([
+        {
+          'isEnabled': True,
+          'lastRun': None,
+          'runInterval': 24 * 60 * 60 * 1000,
+          **({'lease': {'owner': 'crashed', 'claimedAt': now - timedelta(minutes=10), 'expiresAt': now - timedelta(seconds=1)}} if index % 10 == 0 else {}),
+        }
+        for index in range(rule_count)
+      ])
+      ensure_schedule(rules_collection=db.rules)
+      start = time.perf_counter()
+      workers = [
+        multiprocessing.Process(target=rule_lease_worker, args=(database_url, database, run_seconds, max_concurrent, time.time() + timeout))
+        for _ in range(worker_count)
+      ]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+      elapsed = time.perf_counter() - start
+      claims = list(db.claims.find())
+      rule_ids = {c['ruleID'] for c in claims}
+      owners = {c['owner'] for c in claims}
+      unreleased = db.rules.count_documents({'lease': {'$ne': None}})
+      valid = len(claims) == rule_count and len(rule_ids) == rule_count and not unreleased
+      failed = failed or not valid
+      log.log(f'{worker_count} workers: {len(claims)} runs of {len(rule_ids)}/{rule_count} rules by {len(owners)} owners, {unreleased} unreleased leases, {len(claims) / elapsed:>7.1f} rules/s {"ok" if valid else "FAILED"}')
+  finally:
+    client.drop_database(database)
+    client.close()
+  if failed:
+    raise click.ClickException('Lease verification failed')
+
+@rules.command(name='verify-claims')
+@click.option('-u', '--database-url', 'database_url', default='mongodb://localhost:27017')
+@click.option('-d', '--database', 'database', default='datadragon_claim_verification')
+@click.option('-r', '--rules', 'rule_count', type=int, default=100)
+@click.option('-w', '--workers', 'worker_count', type=int, default=8)
+@click.option('-n', '--rounds', 'rounds', type=int, default=5)
+@pass_data_dragon
+def rules_verify_claims(data_dragon: DataDragon, database_url: str, database: str, rule_count: int, worker_count: int, rounds: int):
+  import random
+  import threading
+  from pymongo import MongoClient
+  from scripts.rule_scheduler import RuleScheduler
+  client = MongoClient(database_url)
+  if database in client.list_database_names():
+    raise click.ClickException(f'Refusing to verify claims in existing database {database}')
+  db = client[database]
+  failed = False
+  try:
+    for round_index in range(rounds):
+      client.drop_database(database)
+      now = datetime.utcnow()
+      leases = [
+        {'owner': 'live', 'claimedAt': now, 'expiresAt': now + timedelta(minutes=5)} if index % 5 == 0 else
+        {'owner': 'crashed', 'claimedAt': now - timedelta(minutes=10), 'expiresAt': now - timedelta(seconds=1)} if index % 5 == 1 else
+        None
+        for index in range(rule_count)
+      ]
+      rule_ids = [
+        str(i)
+        for i in db.rules.insert_many([
+          {'isEnabled': True, 'lastRun': None, 'nextRunAt': now - timedelta(minutes=1), **({'lease': lease} if lease is not None else {})}
+          for lease in leases
+        ]).inserted_ids
+      ]
+      live_rule_ids = {rule_id for rule_id, lease in zip(rule_ids, leases) if lease is not None and lease['owner'] == 'live'}
+      barrier = threading.Barrier(worker_count)
+      claims: Dict[str, List[str]] = {}
+      renewals: Dict[str, int] = {}
+      claims_lock = threading.Lock()
+
+      def claim_all(index: int):
+        worker_client = MongoClient(database_url)
+        scheduler = RuleScheduler(rules_collection=worker_client[database].rules, run_rule=None, owner=f'verifier-{index}')
+        shuffled_rule_ids = random.sample(rule_ids, len(rule_ids))
+        barrier.wait()
+        claimed = [rule_id for rule_id in shuffled_rule_ids if scheduler.claim(rule_id=rule_id, now=datetime.utcnow()) is not None]
+        barrier.wait()
+        scheduler._running = {rule_id: None for rule_id in rule_ids}
+        renewed = scheduler.renew_leases()
+        with claims_lock:
+          for rule_id in claimed:
+            claims.setdefault(rule_id, []).append(scheduler.owner)
+          renewals[scheduler.owner] = renewed
+        worker_client.close()
+
+      workers = [threading.Thread(target=claim_all, args=(index,)) for index in range(worker_count)]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+
+      owners = {str(d['_id']): d['lease']['owner'] for d in db.rules.find({'lease': {'$ne': None}}, {'lease': 1})}
+      double_claims = [rule_id for rule_id, claimers in claims.items() if len(claimers) > 1]
+      stolen = [rule_id for rule_id in claims if rule_id in live_rule_ids]
+      unclaimed = [rule_id for rule_id in rule_ids if rule_id not in live_rule_ids and rule_id not in claims]
+      mismatched = [rule_id for rule_id, claimers in claims.items() if owners.get(rule_id) != claimers[0]]
+      misrenewed = [owner for owner, renewed in renewals.items() if renewed != sum(1 for claimers in claims.values() if claimers[0] == owner)]
+      valid = not (double_claims or stolen or unclaimed or mismatched or misrenewed)
+      failed = failed or not valid
+      log.log(f'Round {round_index + 1}: {len(claims)} of {rule_count - len(live_rule_ids)} claimable rules claimed by {len({c[0] for c in claims.values()})} of {worker_count} workers, {len(double_claims)} double claims, {len(stolen)} live leases stolen, {len(unclaimed)} unclaimed, {len(mismatched)} lease owner mismatches, {len(misrenewed)} workers renewing leases they do not hold {"ok" if valid else "FAILED"}')
+  finally:
+    client.drop_database(database)
+    client.close()
+  if failed:
+    raise click.ClickException('Claim verification failed')
+
+@rules.command(name='verify-runner')
+@click.option('-u', '--database-url', 'database_url', default='mongodb://localhost:27017')
+@click.option('-d', '--database', 'database', default='datadragon_runner_verification')
+@pass_data_dragon
+def rules_verify_runner(data_dragon: DataDragon, database_url: str, database: str):
+  from bson import ObjectId
+  from pymongo import MongoClient
+  from scripts.rule_scheduler import scheduled_rule_runner
+  client = MongoClient(database_url)
+  if database in client.list_database_names():
+    raise click.ClickException(f'Refusing to verify the rule runner in existing database {database}')
+  db = client[database]
+  executions = []
+
+  class VerificationRule:
+    def __init__(self, rule_id: str):
+      self._id = rule_id
+      self.dryRun = False
+
+  class VerificationRuleExecutor:
+    impact_store = None
+    write_failures = []
+
+    def __init__(self):
+      self.rulesCollection = db.rules
+      self.rulesHistoryCollection = db.rulesHistory
+
+    def get_rule(self, rule_id: str) -> VerificationRule:
+      return VerificationRule(rule_id=rule_id)
+
+    def execute(self, credentials: any, rule: VerificationRule, granularity: str, start_date: datetime, end_date: datetime) -> Dict[str, any]:
+      executions.append({
+        'ruleID': rule._id,
+        'credentials': credentials,
+        'granularity': granularity,
+        'startDate': start_date,
+        'endDate': end_date,
+      })
+      if failing:
+        raise RuntimeError('Verification rule failure')
+      return {'report': 'campaignId\n1\n'}
+
+  failures = []
+  try:
+    user_id = ObjectId()
+    credential = {'org_name': 'verification'}
+    db.credentials.insert_one({'user': user_id, 'target': 'apple_search_ads', 'name': 'verification', 'credential': credential})
+    rule_id = db.rules.insert_one({
+      'user': user_id,
+      'account': f'user_{user_id}_credential_apple-5Fsearch-5Fads_verification',
+      'channel': 'apple_search_ads',
+      'isEnabled': True,
+      'lastRun': None,
+      'lastTriggered': None,
+      'runInterval': 60 * 60 * 1000,
+      'dataCheckRange': 7 * 24 * 60 * 60 * 1000,
+      'shouldSendEmail': False,
+      'shouldMonitor': False,
+      'metadata': {'description': 'runner verification rule', 'title': None},
+    }).inserted_id
+    today = datetime.now()
+    for name, configuration, failing in [
+      ('without rate limits', {**data_dragon.configuration, 'dry_run_only': True, 'rate_limits': {}}, False),
+      ('with rate limits', {**data_dragon.configuration, 'dry_run_only': True, 'rate_limits': {'default': {'per_call': True}}}, False),
+      ('failing execution', {**data_dragon.configuration, 'dry_run_only': True, 'rate_limits': {}}, True),
+    ]:
+      executions.clear()
+      db.rules.update_one({'_id': rule_id}, {'$set': {'lastTriggered': None}})
+      run_rule = scheduled_rule_runner(
+        db=db,
+        create_rule_executor=VerificationRuleExecutor,
+        configure=configuration
+      )
+      try:
+        run_rule(db.rules.find_one({'_id': rule_id}))
+        if failing:
+          failures.append(f'{name}: run did not raise the execution error')
+      except Exception:
+        if not failing:
+          failures.append(f'{name}: run failed\n{traceback.format_exc()}')
+          continue
+      if len(executions) != 1:
+        failures.append(f'{name}: expected one execution, got {len(executions)}')
+        continue
+      execution = executions[0]
+      if execution['ruleID'] != str(rule_id):
+        failures.append(f'{name}: executed rule {execution["ruleID"]} instead of {rule_id}')
+      if execution['endDate'] != datetime(today.year, today.month, today.day) or (execution['endDate'] - execution['startDate']).days != 7:
+        failures.append(f'{name}: executed {execution["startDate"]} to {execution["endDate"]} instead of the 7 local days up to {today:%Y-%m-%d}')
+      last_triggered = db.rules.find_one({'_id': rule_id})['lastTriggered']
+      if (last_triggered is None) != failing:
+        failures.append(f'{name}: lastTriggered is {last_triggered}')
+      failed_history = db.rulesHistory.find_one({'ruleID': rule_id, 'historyType': 'failed'})
+      if (failed_history is not None) != failing:
+        failures.append(f'{name}: failed history is {failed_history}')
+      log.log(f'{name}: executed rule {execution["ruleID"]} from {execution["startDate"]:%Y-%m-%d} to {execution["endDate"]:%Y-%m-%d}')
+
+    db.rules.update_one({'_id': rule_id}, {'$set': {'shouldSendEmail': True}})
+    executions.clear()
+    try:
+      scheduled_rule_runner(db=db, create_rule_executor=VerificationRuleExecutor, configure=data_dragon.configuration)(db.rules.find_one({'_id': rule_id}))
+      failures.append('notifying rule: run did not refuse a rule that sends email')
+    except ValueError:
+      pass
+    if executions:
+      failures.append('notifying rule: executed a rule that sends email')
+  finally:
+    client.drop_database(database)
+    client.close()
+  for failure in failures:
+    log.log(failure)
+  if failures:
+    raise click.ClickException('Rule runner verification failed')
+
+@rules.command(name='backtest')
+@click.option('-r', '--rule-id', 'rule_id', required=True)
+@click.option('-f', '--from-date', 'from_date', required=True)
+@click.option('-t', '--to-date', 'to_date', required=True)
+@click.option('-g', '--granularity', 'granularity', type=click.Choice(['HOURLY', 'DAILY']), default='DAILY')
+@click.option('-w', '--window-days', 'window_days', type=click.IntRange(min=1), default=1)
+@click.option('-s', '--step-days', 'step_days', type=click.IntRange(min=1))
+@click.option('-p', '--processes', 'processes', type=int)
+@click.option('-o', '--output', 'output_path', type=click.Path(dir_okay=False, writable=True))
+@pass_data_dragon
+def rules_backtest(data_dragon: DataDragon, rule_id: str, from_date: str, to_date: str, granularity: str, window_days: int, step_days: Optional[int], processes: Optional[int], output_path: Optional[str]):
+  from bson import ObjectId
+  from scripts.api import prepare_credentials, credentials_fingerprint
+  from scripts.accounts import account_credentials
+  from scripts.map_manifest import register_map_identifiers
+  from scripts.rule_executor import RuleExecutor, default_collection_options
+  register_map_identifiers()
+  layer = SQL.Layer()
+  layer.connect()
+  db = layer.get_database()
+  rule_executor = RuleExecutor(options=default_collection_options, database=db)
+  rule_document = rule_executor.rulesCollection.find_one({'_id': ObjectId(rule_id)}, {'account': 1, 'channel': 1})
+  if rule_document is None:
+    raise click.ClickException(f'Rule {rule_id} not found')
+  credentials = account_credentials(db=db, account=rule_document['account'])
+  if credentials is None:
+    raise click.ClickException(f'No credentials for account {rule_document["account"]}')
+  start = time.perf_counter()
+  actions = rule_executor.backtest(
+    credentials=prepare_credentials({'credentials': credentials}),
+    rule_id=rule_id,
+    granularity=granularity,
+    start_date=datetime.strptime(from_date, '%Y-%m-%d'),
+    end_date=datetime.strptime(to_date, '%Y-%m-%d'),
+    window_days=window_days,
+    step_days=step_days,
+    processes=processes,
+    rate_limit={
+      'channel': rule_document['channel'],
+      'credentials_fingerprint': credentials_fingerprint(credentials),
+      'buckets': data_dragon.configuration.get('rate_limits', {}),
+    },
+    database_configuration=data_dragon.environment['databases']['default']
+  )
+  layer.disconnect()
+  elapsed = time.perf_counter() - start
+  if output_path is not None:
+    actions.to_csv(output_path, index=False)
+  if actions.empty:
+    log.log(f'No actions for rule {rule_id} from {from_date} to {to_date} in {elapsed:.1f} s')
+    return
+  summary = actions.groupby(['targetType', 'targetID', 'adjustmentType'], dropna=False).agg(
+    windows=('windowStart', 'nunique'),
+    firstWindow=('windowStart', 'min'),
+    lastWindow=('windowStart', 'max')
+  ).reset_index()
+  log.log(f'{len(actions.index)} actions in {actions.windowStart.nunique()} windows for rule {rule_id} from {from_date} to {to_date} in {elapsed:.1f} s\n{summary.to_string(index=False)}')
+
+@rules.command(name='benchmark')
+@click.option('-r', '--rule-id', 'rule_ids', multiple=True, required=True)
+@click.option('-f', '--from-date', 'from_date', default='2020-05-01')
+@click.option('-t', '--to-date', 'to_date', default='2020-05-07')
+@click.option('-g', '--granularity', 'granularity', type=click.Choice(['HOURLY', 'DAILY']), default='DAILY')
+@click.option('-d', '--cassette-directory', 'cassette_directory')
+@click.option('--record', 'should_record', is_flag=True)
+@click.option('-l', '--latency', 'latency', default='recorded')
+@click.option('-n', '--repeat', 'repeat', type=int, default=5)
+@pass_data_dragon
+def rules_benchmark(data_dragon: DataDragon, rule_ids: Tuple[str], from_date: str, to_date: str, granularity: str, cassette_directory: Optional[str], should_record: bool, latency: str, repeat: int):
+  from bson import ObjectId
+  from scripts.api import prepare_credentials
+  from scripts.accounts import account_credentials
+  from scripts.channel import Channel
+  from scripts.cassette import recording, replaying, cassette_path
+  from scripts.map_manifest import register_map_identifiers
+  from scripts.rule_loader import prefetch_rule_documents
+  from scripts.rule_executor import RuleExecutor, default_collection_options
+  register_map_identifiers()
+  layer = SQL.Layer()
+  layer.connect()
+  db = layer.get_database()
+  benchmark_collections = {
+    'rulesCollection': 'benchmarkRules',
+    'rulesHistoryCollection': 'benchmarkRulesHistory',
+    'rulesMonitorCollection': 'benchmarkRulesMonitor',
+    'ruleConditionGroupsCollection': 'benchmarkRuleConditionGroups',
+  }
+  if any(c in db.list_collection_names() for c in benchmark_collections.values()):
+    raise click.ClickException(f'Refusing to benchmark with existing collections {", ".join(benchmark_collections.values())}')
+  directory = Path(cassette_directory) if cassette_directory is not None else cassette_path / 'benchmark'
+  replay_latency = latency if latency == 'recorded' else float(latency)
+  start_date = datetime.strptime(from_date, '%Y-%m-%d')
+  end_date = datetime.strptime(to_date, '%Y-%m-%d')
+  rule_executor = RuleExecutor(
+    options={**default_collection_options, **benchmark_collections},
+    database=db
+  )
+
+  def execute(rule_id: str, credentials: Dict[str, any]) -> float:
+    rule = rule_executor.get_rule(rule_id=rule_id)
+    rule.dryRun = True
+    start = time.perf_counter()
+    rule_executor.execute(
+      credentials=credentials,
+      rule=rule,
+      granularity=granularity,
+      start_date=start_date,
+      end_date=end_date
+    )
+    return time.perf_counter() - start
+
+  try:
+    rules, condition_groups = prefetch_rule_documents(
+      rules_collection=db[default_collection_options['rulesCollection']],
+      condition_groups_collection=db[default_collection_options['ruleConditionGroupsCollection']],
+      rule_ids=list(rule_ids)
+    )
+    missing_rule_ids = set(rule_ids) - {str(r['_id']) for r in rules}
+    if missing_rule_ids:
+      raise click.ClickException(f'Rules not found: {", ".join(sorted(missing_rule_ids))}')
+    db[benchmark_collections['rulesCollection']].insert_many(rules)
+    if condition_groups:
+      db[benchmark_collections['ruleConditionGroupsCollection']].insert_many(condition_groups)
+    rule_documents = {str(r['_id']): r for r in rules}
+
+    total_runs = 0
+    total_seconds = 0
+    for rule_id in rule_ids:
+      credentials = account_credentials(db=db, account=rule_documents[rule_id]['account'])
+      if credentials is None:
+        raise click.ClickException(f'No credentials for account {rule_documents[rule_id]["account"]}')
+      credentials = prepare_credentials({'credentials': credentials})
+      if rule_documents[rule_id].get('channel') == Channel.google_ads.value:
+        log.log(f'Warning: rule {rule_id} uses Google Ads, whose gRPC API calls bypass requests, so cassettes neither record nor replay them')
+      path = directory / f'{rule_id}_{granularity}_{from_date}_{to_date}.json.gz'
+      if should_record:
+        with recording(path=path) as cassette:
+          seconds = execute(rule_id=rule_id, credentials=credentials)
+        log.log(f'Recorded {cassette.requests} requests in {seconds:.2f} s for rule {rule_id} to {path}')
+        continue
+      if not path.exists():
+        raise click.ClickException(f'No cassette for rule {rule_id} at {path}; run with --record first')
+      samples = []
+      for _ in range(repeat):
+        db[benchmark_collections['rulesHistoryCollection']].delete_many({})
+        db[benchmark_collections['rulesMonitorCollection']].delete_many({})
+        with replaying(path=path, latency=replay_latency) as player:
+          samples.append(execute(rule_id=rule_id, credentials=credentials))
+      samples.sort()
+      total_runs += len(samples)
+      total_seconds += sum(samples)
+      log.log(f'rule {rule_id}  {player.requests:>5} requests  median {samples[len(samples) // 2] * 1000:>9.1f} ms  p95 {samples[int(0.95 * (len(samples) - 1))] * 1000:>9.1f} ms  min {samples[0] * 1000:>9.1f} ms  latency {player.statistics["latencySeconds"] * 1000:>9.1f} ms  fuzzy matches {player.fuzzy_matches}')
+    if total_runs:
+      log.log(f'{total_runs} rule executions in {total_seconds:.2f} s, {total_runs / total_seconds:.2f} rules/s with {latency} latency')
+  finally:
+    for collection in benchmark_collections.values():
+      db.drop_collection(collection)
+    layer.disconnect()
+
 @run.group(name='configure')
 @click.pass_context
 @invoke_subcommand(context_aware=False)
@@ -1151,6 +1702,322 @@ def api_test_rule(data_dragon: DataDragon, test_url: Optional[str], credential_u
   adjustment_output = '\n'.join(f'{a["targetType"]} {a["targetID"]} {a["adjustmentType"]} from {a["adjustmentFrom"]} to {a["adjustmentTo"]}' for a in actions)
   data_dragon.user.present_message(test_format(f'††† Finished test with {channel} test rule {rule["_id"]}\nConfiguration:\n{json.dumps(test, indent=2)}\nAdjustments:\n{adjustment_output}'))
 
+@api.group(name='benchmark')
+@click.pass_context
+@invoke_subcommand(context_aware=False)
+def api_benchmark():
+  pass
+
+@api_benchmark.command(name='startup')
+@click.option('-c', '--command', 'commands', multiple=True)
+@click.option('-n', '--repeat', 'repeat', type=int, default=3)
+@click.pass_obj
+def api_benchmark_startup(data_dragon: DataDragon, commands: Tuple[str], repeat: int):
+  from scripts.api import Command, command_modules
+  root_path = Path(__file__).parent.parent
+  benchmark_path = root_path / 'output' / 'state' / 'startup_benchmark.jsonl'
+  benchmark_commands = [Command(c) for c in commands] if commands else list(command_modules)
+  benchmark_date = datetime.utcnow().isoformat()
+
+  def measure(statement: str) -> Tuple[float, float, List[Tuple[str, int]]]:
+    start = time.perf_counter()
+    completed = subprocess.run(
+      [sys.executable, '-X', 'importtime', '-c', statement],
+      cwd=str(root_path),
+      capture_output=True
+    )
+    wall_time = time.perf_counter() - start
+    if completed.returncode != 0:
+      raise click.ClickException(f'Startup benchmark failed for {statement}:\n{completed.stderr.decode()}')
+    self_total = 0
+    top_level = []
+    for line in completed.stderr.decode().splitlines():
+      match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+      if not match:
+        continue
+      self_total += int(match.group(1))
+      if len(match.group(3)) == 1:
+        top_level.append((match.group(4), int(match.group(2))))
+    return wall_time * 1000, self_total / 1000, sorted(top_level, key=lambda t: -t[1])[:5]
+
+  records = []
+  for command in [None, *benchmark_commands]:
+    statement = 'import scripts.api' if command is None else f'from scripts.api import Command, import_command_modules; import_command_modules(Command({command.value!r}))'
+    samples = [measure(statement=statement) for _ in range(repeat)]
+    samples.sort(key=lambda s: s[0])
+    wall_ms, import_ms, top_imports = samples[len(samples) // 2]
+    records.append({
+      'date': benchmark_date,
+      'command': command.value if command is not None else 'api',
+      'repeat': repeat,
+      'wall_ms': round(wall_ms, 1),
+      'import_ms': round(import_ms, 1),
+      'top_imports': [{'module': m, 'cumulative_ms': round(t / 1000, 1)} for m, t in top_imports],
+    })
+    log.log(f'{records[-1]["command"]:<16} {records[-1]["wall_ms"]:>9.1f} ms wall {records[-1]["import_ms"]:>9.1f} ms imports  {", ".join(m for m, _ in top_imports)}')
+
+  with open(benchmark_path, 'a') as f:
+    for record in records:
+      f.write(json.dumps(record) + '\n')
+  log.log(f'Startup benchmark appended to {benchmark_path}')
+
+@api_benchmark.command(name='report-handoff')
+@click.option('-r', '--rows', 'rows', type=int, default=1000000)
+@click.pass_obj
+def api_benchmark_report_handoff(data_dragon: DataDragon, rows: int):
+  import numpy as np
+  import pandas as pd
+  from scripts.report_output import write_report_file, read_report_file, ReportFileFormat
+  random = np.random.default_rng(0)
+  report = pd.DataFrame({
+    'date': pd.date_range('2020-01-01', periods=rows, freq='min'),
+    'campaign_id': random.integers(1, 1000, rows).astype(str),
+    'keyword': [f'keyword {i % 5000}' for i in range(rows)],
+    'impressions': random.integers(0, 10000, rows),
+    'taps': random.integers(0, 500, rows),
+    'spend': random.random(rows) * 100,
+  })
+
+  def csv_in_json() -> int:
+    message = json.dumps({'data': report.to_csv(index=False)})
+    pd.read_csv(io.StringIO(json.loads(message)['data']))
+    return len(message)
+
+  def file_handoff(file_format: ReportFileFormat) -> int:
+    file_info = write_report_file(report=report, file_format=file_format)
+    message = json.dumps({'file': file_info})
+    read_report_file(path=json.loads(message)['file']['path'])
+    size = Path(file_info['path']).stat().st_size
+    Path(file_info['path']).unlink()
+    return size
+
+  for name, handoff in [
+    ('csv in json', csv_in_json),
+    ('arrow file', lambda: file_handoff(file_format=ReportFileFormat.arrow)),
+    ('parquet file', lambda: file_handoff(file_format=ReportFileFormat.parquet)),
+  ]:
+    start = time.perf_counter()
+    size = handoff()
+    log.log(f'{name:<14} {rows} rows {time.perf_counter() - start:>8.2f} s {size / 1024 / 1024:>9.1f} MB')
+
+@api_benchmark.command(name='encoder')
+@click.option('-a', '--actions', 'action_count', type=int, default=5000)
+@click.option('-n', '--repeat', 'repeat', type=int, default=5)
+@click.pass_obj
+def api_benchmark_encoder(data_dragon: DataDragon, action_count: int, repeat: int):
+  import numpy as np
+  import pandas as pd
+  from regla import RuleSerializer
+  from scripts.encoding import encode_message, orjson
+  if orjson is None:
+    raise click.ClickException('orjson is not installed, so there is no fast encoder to compare')
+  random = np.random.default_rng(0)
+  report = pd.DataFrame({
+    'keywordId': random.integers(1, 10 ** 9, action_count),
+    'keyword': [f'keyword {i}' for i in range(action_count)],
+    'impressions': random.integers(0, 10000, action_count),
+    'taps': random.integers(0, 500, action_count),
+    'localSpend': random.random(action_count) * 100,
+  })
+  message = {
+    'result': {
+      'report': report.to_csv(index=False),
+      'actionResults': [
+        {
+          'targetID': row.keywordId,
+          'bid': row.localSpend,
+          'taps': row.taps,
+          'date': pd.Timestamp('2020-05-01') + pd.Timedelta(hours=index % 24),
+          'logs': [{'targetType': 'keyword', 'targetID': str(row.keywordId), 'actionDescription': f'Decrease bid from {row.localSpend:.2f} to {row.localSpend * 0.9:.2f}'}],
+          'errors': [None],
+          'apiResponse': {'data': [{'id': row.keywordId, 'bidAmount': {'amount': str(row.localSpend), 'currency': 'USD'}}]},
+        }
+        for index, row in enumerate(report.itertuples())
+      ],
+    },
+  }
+
+  timings = {}
+  outputs = {}
+  for name, fast in [('RuleSerializer', False), ('fast encoder', True)]:
+    samples = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      outputs[name] = encode_message(message, cls=RuleSerializer, fast=fast)
+      samples.append(time.perf_counter() - start)
+    timings[name] = sorted(samples)[len(samples) // 2]
+    log.log(f'{name:<16} {action_count} actions {timings[name] * 1000:>9.1f} ms {len(outputs[name]) / 1024:>9.1f} KB')
+  equivalent = json.loads(outputs['RuleSerializer']) == json.loads(outputs['fast encoder'])
+  log.log(f'Speedup {timings["RuleSerializer"] / timings["fast encoder"]:.1f}x, equivalent output: {equivalent}')
+
+@api_benchmark.command(name='rule-load')
+@click.option('-u', '--database-url', 'database_url', default='mongodb://localhost:27017')
+@click.option('-d', '--database', 'database', default='datadragon_benchmark')
+@click.option('-c', '--count', 'counts', type=int, multiple=True, default=[1, 10, 100])
+@click.option('-n', '--repeat', 'repeat', type=int, default=3)
+@click.pass_obj
+def api_benchmark_rule_load(data_dragon: DataDragon, database_url: str, database: str, counts: Tuple[int], repeat: int):
+  from bson import ObjectId
+  from scripts.mongo_pool import mongo_client_pool
+  from scripts.rule_executor import RuleExecutor
+  client = mongo_client_pool.client(url=database_url)
+  if database in client.list_database_names():
+    raise click.ClickException(f'Refusing to benchmark in existing database {database}')
+  options = {
+    'databaseURL': database_url,
+    'database': database,
+    'rulesCollection': 'rules',
+    'rulesHistoryCollection': 'rulesHistory',
+    'rulesMonitorCollection': 'rulesMonitor',
+    'ruleConditionGroupsCollection': 'ruleConditionGroups',
+  }
+  try:
+    db = client[database]
+    rule_ids = []
+    for index in range(max(counts)):
+      subgroup_id = db.ruleConditionGroups.insert_one({
+        'conditions': [{'metric': 'totalImpressions', 'metricValue': 100, 'operator': 'greater'}],
+        'subgroups': [],
+        'operator': 'all',
+      }).inserted_id
+      group_id = db.ruleConditionGroups.insert_one({
+        'conditions': [{'metric': 'reavgCPA', 'metricValue': 2.5, 'operator': 'greater'}],
+        'subgroups': [subgroup_id],
+        'operator': 'any',
+      }).inserted_id
+      rule_ids.append(str(db.rules.insert_one({
+        'user': ObjectId(),
+        'created': datetime.utcnow(),
+        'modified': datetime.utcnow(),
+        'lastRun': None,
+        'lastTriggered': None,
+        'channel': 'apple_search_ads',
+        'account': 'benchmark',
+        'orgID': 1,
+        'campaignID': index,
+        'adgroupID': None,
+        'granularity': 'DAILY',
+        'isEnabled': True,
+        'dataCheckRange': 7,
+        'runInterval': 60 * 60 * 1000,
+        'tasks': [{'conditionGroup': group_id, 'actions': [{'action': 'dec_bid', 'adjustmentValue': 10, 'adjustmentLimit': 0.5}]}],
+        'shouldSendEmail': False,
+        'shouldPerformAction': False,
+        'shouldMonitor': False,
+        'safeMode': True,
+        'metadata': {'accountName': 'benchmark', 'campaignName': f'campaign {index}', 'adGroupName': 'All', 'actionDescription': 'Decrease bid', 'description': f'benchmark rule {index}', 'title': None},
+        'options': {},
+      }).inserted_id))
+
+    rule_executor = RuleExecutor(options=options)
+    for count in counts:
+      timings = {}
+      for name, load in [
+        ('get_rule', lambda ids: [rule_executor.get_rule(rule_id=i) for i in ids]),
+        ('get_rules', lambda ids: rule_executor.get_rules(rule_ids=ids)),
+      ]:
+        samples = []
+        for _ in range(repeat):
+          start = time.perf_counter()
+          load(rule_ids[:count])
+          samples.append(time.perf_counter() - start)
+        timings[name] = sorted(samples)[len(samples) // 2]
+      log.log(f'{count:>4} rules  get_rule {timings["get_rule"] * 1000:>9.1f} ms  get_rules {timings["get_rules"] * 1000:>9.1f} ms  speedup {timings["get_rule"] / timings["get_rules"]:.1f}x')
+  finally:
+    client.drop_database(database)
+    mongo_client_pool.close()
+
+@api.group(name='check')
+@click.pass_context
+@invoke_subcommand(context_aware=False)
+def api_check():
+  pass
+
+def strip_source_report_metadata_by_row(report: any) -> Dict[str, any]:
+  import pandas as pd
+  from io_map import IOMultiSourceReporter
+  metadata = []
+  if '' not in report:
+    report[''] = None
+  report.reset_index(drop=True, inplace=True)
+  drop_indices = []
+  for index in report.index:
+    row = report.loc[index]
+    notna_columns = [c for c in row.index if pd.notna(row[c])]
+    if not notna_columns or notna_columns == ['']:
+      drop_indices.append(index)
+    row_metadata = json.loads(row['']) if '' in row and pd.notna(row['']) else []
+    for metadata_entry in row_metadata:
+      if set(metadata_entry.keys()) == {'credential', 'map'} and metadata_entry['map'] == IOMultiSourceReporter._get_map_identifier():
+        if index not in drop_indices and len(row_metadata) == 1:
+          report.loc[index, ''] = metadata_entry['credential']
+        continue
+      if metadata_entry not in metadata:
+        metadata.append(metadata_entry)
+  if drop_indices:
+    report.drop(index=drop_indices, inplace=True)
+    report.reset_index(drop=True, inplace=True)
+  return {
+    'metadata': metadata,
+    'report': report,
+  }
+
+@api_check.command(name='strip-metadata')
+@click.option('-r', '--rows', 'rows', type=int, default=500000)
+@click.option('-e', '--equivalence-rows', 'equivalence_rows', type=int, default=20000)
+@click.option('-c', '--credentials', 'credential_count', type=int, default=3)
+@click.option('-s', '--seed', 'seed', type=int, default=0)
+@click.pass_obj
+def api_check_strip_metadata(data_dragon: DataDragon, rows: int, equivalence_rows: int, credential_count: int, seed: int):
+  import numpy as np
+  import pandas as pd
+  from io_map import IOMultiSourceReporter
+  from scripts.report import StripSourceReportMetadataMap
+  random = np.random.default_rng(seed)
+  source_map_identifier = IOMultiSourceReporter._get_map_identifier()
+  metadata_values = [
+    json.dumps([{'credential': f'credential_{index}', 'map': source_map_identifier}])
+    for index in range(credential_count)
+  ] + [
+    json.dumps([{'credential': 'credential_0', 'map': source_map_identifier}, {'map': 'heathcliff/IOAppleSearchAdsReporter', 'warning': 'partial data'}]),
+    json.dumps([{'map': 'hazel/IOGoogleAdsReporter', 'columns': ['spend', 'impressions']}]),
+    json.dumps([{'columns': ['spend', 'impressions'], 'map': 'hazel/IOGoogleAdsReporter'}]),
+  ]
+
+  def generate_report(row_count: int) -> pd.DataFrame:
+    empty = random.random(row_count) < 0.05
+    report = pd.DataFrame({
+      'campaignId': np.where(empty, None, random.integers(0, 1000, row_count).astype(str)).astype(object),
+      'spend': np.where(empty | (random.random(row_count) < 0.1), np.nan, np.round(random.random(row_count) * 100, 2)),
+      'impressions': np.where(empty, np.nan, random.integers(0, 100000, row_count).astype(float)),
+    })
+    report[''] = np.where(random.random(row_count) < 0.02, None, random.choice(np.array(metadata_values, dtype=object), row_count))
+    return report
+
+  equivalence_report = generate_report(row_count=equivalence_rows)
+  start = time.perf_counter()
+  expected = strip_source_report_metadata_by_row(report=equivalence_report.copy())
+  reference_seconds = time.perf_counter() - start
+  output = StripSourceReportMetadataMap().run(report=equivalence_report.copy())
+  mismatches = []
+  if output['metadata'] != expected['metadata']:
+    mismatches.append(f'metadata {json.dumps(output["metadata"])} != {json.dumps(expected["metadata"])}')
+  try:
+    pd.testing.assert_frame_equal(output['report'], expected['report'])
+  except AssertionError as e:
+    mismatches.append(f'report: {e}')
+  for mismatch in mismatches:
+    log.log(f'Mismatch in {mismatch}')
+  log.log(f'{equivalence_rows} rows, {len(mismatches)} mismatches')
+
+  report = generate_report(row_count=rows)
+  start = time.perf_counter()
+  output = StripSourceReportMetadataMap().run(report=report)
+  columnar_seconds = time.perf_counter() - start
+  log.log(f'by row {reference_seconds / equivalence_rows * rows:>9.2f} s per {rows} rows (extrapolated), columnar {columnar_seconds:>9.2f} s, {len(output["report"].index)} rows kept')
+  if mismatches:
+    raise click.ClickException('Columnar metadata stripping differs from the row by row implementation')
+
 @run.command()
 @click.option('-t/-T', '--terminate/--no-terminate', 'should_stop', is_flag=True, default=True)
 @click.option('-m/-M', '--migrate/--no-migrate', 'should_migrate', is_flag=True)
@@ -0,0 +1,147 @@
+import os
+import json
+import queue
+import socket
+import threading
+import traceback
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Callable, Optional
+from .api import CommandIO, command_modules, import_command_modules, execute_command
+
+class CommandConnection:
+  write_line: Callable[[str], None]
+  write_lock: threading.Lock
+  inputs: Dict[str, queue.Queue]
+
+  def __init__(self, write_line: Callable[[str], None]):
+    self.write_line = write_line
+    self.write_lock = threading.Lock()
+    self.inputs = {}
+
+  def write(self, request_id: Optional[str], text: str):
+    with self.write_lock:
+      self.write_line(f'{{"id":{json.dumps(request_id)},"message":{text}}}')
+
+  def end(self, request_id: Optional[str], errors: Optional[list]=None):
+    self.inputs.pop(request_id, None)
+    frame = {'id': request_id, 'end': True}
+    if errors:
+      frame['errors'] = errors
+    with self.write_lock:
+      self.write_line(json.dumps(frame))
+
+  def read(self, request_id: Optional[str]) -> str:
+    line = self.inputs[request_id].get()
+    if line is None:
+      raise EOFError(f'Connection closed before input was received for request {request_id}')
+    return line
+
+  def command_io(self, request_id: Optional[str]) -> CommandIO:
+    self.inputs[request_id] = queue.Queue()
+    return CommandIO(
+      write_line=lambda line: self.write(request_id=request_id, text=line),
+      read_line=lambda: self.read(request_id=request_id)
+    )
+
+  def close(self):
+    for request_input in list(self.inputs.values()):
+      request_input.put(None)
+
+class CommandServer:
+  configure: Dict[str, any]
+  executor: ThreadPoolExecutor
+
+  def __init__(self, configure: Dict[str, any], max_workers: int=4):
+    from .fetch_cache import report_fetch_cache
+    from .credential_cache import credential_cache
+    from .mongo_pool import mongo_client_pool
+    self.configure = configure
+    self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    report_fetch_cache.configure(**configure.get('report_fetch_cache', {}))
+    credential_cache.configure(**configure.get('credential_cache', {}))
+    mongo_client_pool.configure(**configure.get('mongo_client_pool', {}))
+
+  def shutdown(self):
+    from .mongo_pool import mongo_client_pool
+    self.executor.shutdown(wait=True)
+    mongo_client_pool.close()
+
+  def preload(self):
+    from .map_manifest import register_map_identifiers
+    for command in command_modules:
+      import_command_modules(command=command)
+    register_map_identifiers()
+
+  def run_request(self, connection: CommandConnection, request_id: Optional[str], args: Dict[str, any], command_io: CommandIO):
+    try:
+      execute_command(
+        args=args,
+        configure=self.configure,
+        command_io=command_io
+      )
+    except Exception:
+      connection.end(request_id=request_id, errors=[traceback.format_exc()])
+    else:
+      connection.end(request_id=request_id)
+
+  def handle_frame(self, connection: CommandConnection, line: str):
+    try:
+      frame = json.loads(line)
+    except json.JSONDecodeError:
+      connection.end(request_id=None, errors=[f'Invalid request frame: {line}'])
+      return
+    request_id = frame.get('id')
+    if 'input' in frame:
+      if request_id in connection.inputs:
+        connection.inputs[request_id].put(frame['input'])
+      return
+    if 'args' not in frame:
+      connection.end(request_id=request_id, errors=['Request frame requires args or input'])
+      return
+    if request_id in connection.inputs:
+      connection.end(request_id=request_id, errors=[f'Request {request_id} is already running'])
+      return
+    command_io = connection.command_io(request_id=request_id)
+    self.executor.submit(self.run_request, connection, request_id, frame['args'], command_io)
+
+  def serve_stream(self, read_line: Callable[[], str], write_line: Callable[[str], None]):
+    connection = CommandConnection(write_line=write_line)
+    try:
+      for line in iter(read_line, ''):
+        if line.strip():
+          self.handle_frame(connection=connection, line=line)
+    finally:
+      connection.close()
+
+  def serve_connection(self, client: socket.socket):
+    with client, client.makefile('r', encoding='utf-8') as reader, client.makefile('w', encoding='utf-8') as writer:
+      def write_line(line: str):
+        writer.write(line + '\n')
+        writer.flush()
+      try:
+        self.serve_stream(
+          read_line=reader.readline,
+          write_line=write_line
+        )
+      except (BrokenPipeError, ConnectionResetError):
+        pass
+
+  def serve_socket(self, path: str):
+    socket_path = Path(path)
+    if socket_path.exists():
+      socket_path.unlink()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      server.bind(str(socket_path))
+      os.chmod(str(socket_path), 0o600)
+      server.listen()
+      while True:
+        client, _ = server.accept()
+        threading.Thread(target=self.serve_connection, args=(client,), daemon=True).start()
+    finally:
+      server.close()
+      if socket_path.exists():
+        socket_path.unlink()
+      self.executor.shutdown(wait=False)
@@ -0,0 +1,71 @@
+import time
+import threading
+
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+class CommandMetrics:
+  command: str
+  start: float
+  spans: List[Dict[str, any]]
+  counters: Dict[str, float]
+  _lock: threading.Lock
+
+  def __init__(self, command: str):
+    self.command = command
+    self.start = time.perf_counter()
+    self.spans = []
+    self.counters = {}
+    self._lock = threading.Lock()
+
+  def add_span(self, span: Dict[str, any]):
+    with self._lock:
+      self.spans.append(span)
+
+  def count(self, name: str, value: float=1):
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  @property
+  def summary(self) -> Dict[str, any]:
+    with self._lock:
+      return {
+        'command': self.command,
+        'seconds': round(time.perf_counter() - self.start, 6),
+        'spans': list(self.spans),
+        **{name: round(value, 6) if isinstance(value, float) else value for name, value in self.counters.items()},
+      }
+
+_timing_context = threading.local()
+
+def current_metrics() -> Optional[CommandMetrics]:
+  return getattr(_timing_context, 'metrics', None)
+
+@contextmanager
+def measuring(metrics: Optional[CommandMetrics]):
+  previous_metrics = current_metrics()
+  _timing_context.metrics = metrics
+  try:
+    yield metrics
+  finally:
+    _timing_context.metrics = previous_metrics
+
+@contextmanager
+def span(name: str, **attributes: any):
+  metrics = current_metrics()
+  span_attributes = dict(attributes)
+  start = time.perf_counter()
+  try:
+    yield span_attributes
+  finally:
+    if metrics is not None:
+      metrics.add_span({
+        'name': name,
+        'seconds': round(time.perf_counter() - start, 6),
+        **span_attributes,
+      })
+
+def count(name: str, value: float=1):
+  metrics = current_metrics()
+  if metrics is not None:
+    metrics.count(name=name, value=value)
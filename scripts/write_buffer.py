@@ -0,0 +1,84 @@
+import time
+import threading
+
+from bson import ObjectId
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.results import InsertOneResult, InsertManyResult
+from typing import Dict, List, Optional
+
+class BufferedCollection:
+  collection: any
+  max_documents: int
+  max_seconds: float
+  failures: List[Dict[str, any]]
+  flushes: int
+  _documents: List[Dict[str, any]]
+  _first_buffered: Optional[float]
+  _lock: threading.RLock
+
+  def __init__(self, collection: any, max_documents: int=500, max_seconds: float=1.0, write_concern: Optional[Dict[str, any]]=None):
+    self.collection = collection if write_concern is None else collection.with_options(write_concern=WriteConcern(**write_concern))
+    self.max_documents = max_documents
+    self.max_seconds = max_seconds
+    self.failures = []
+    self.flushes = 0
+    self._documents = []
+    self._first_buffered = None
+    self._lock = threading.RLock()
+
+  def _buffer(self, documents: List[Dict[str, any]]) -> List[any]:
+    with self._lock:
+      for document in documents:
+        document.setdefault('_id', ObjectId())
+      if self._first_buffered is None:
+        self._first_buffered = time.monotonic()
+      self._documents.extend(documents)
+      if len(self._documents) >= self.max_documents or time.monotonic() - self._first_buffered >= self.max_seconds:
+        self.flush()
+    return [document['_id'] for document in documents]
+
+  def insert_one(self, document: Dict[str, any], *args, **kwargs) -> InsertOneResult:
+    return InsertOneResult(self._buffer([document])[0], self.collection.write_concern.acknowledged)
+
+  def insert_many(self, documents: List[Dict[str, any]], *args, **kwargs) -> InsertManyResult:
+    return InsertManyResult(self._buffer(list(documents)), self.collection.write_concern.acknowledged)
+
+  def insert(self, documents: any, *args, **kwargs) -> any:
+    if isinstance(documents, dict):
+      return self._buffer([documents])[0]
+    return self._buffer(list(documents))
+
+  def flush(self):
+    with self._lock:
+      documents = self._documents
+      self._documents = []
+      self._first_buffered = None
+      if not documents:
+        return
+      self.flushes += 1
+      try:
+        self.collection.insert_many(documents, ordered=False)
+      except BulkWriteError as e:
+        write_errors = e.details.get('writeErrors', [])
+        self.failures.append({
+          'collection': self.collection.name,
+          'documents': len(documents),
+          'failed': len(write_errors) or len(documents),
+          'error': write_errors[0].get('errmsg', str(e)) if write_errors else str(e),
+        })
+      except PyMongoError as e:
+        self.failures.append({
+          'collection': self.collection.name,
+          'documents': len(documents),
+          'failed': len(documents),
+          'error': str(e),
+        })
+
+  def __getattr__(self, name: str) -> any:
+    self.flush()
+    return getattr(self.collection, name)
+
+  def __getitem__(self, name: str) -> any:
+    self.flush()
+    return self.collection[name]